@@ -0,0 +1,207 @@
+import functools
+import operator
+import re
+
+
+def includes(a, b):
+    if a is None:
+        return True
+    return a.lower() in b.lower()
+
+
+def time_variations(time):
+    """
+    >>> time_variations("13:00")
+    ['13:00', '1300', '13:00', '1300']
+    >>> time_variations("9:05")
+    ['9:05', '905', '9:05', '905']
+    >>> time_variations("noon")
+    ['noon', 'noon']
+    """
+
+    time_split = time.split(":")
+    try:
+        hour = int(time_split[0])
+        minute = int(time_split[1])
+
+        return [
+            time,
+            time.replace(":", ""),
+            f"{hour}:{minute:02}",
+            f"{hour}:{minute:02}".replace(":", ""),
+        ]
+    except ValueError:
+        return [time, time.replace(":", "")]
+
+
+WHITESPACE = re.compile(r"[ \xa0]+")
+
+
+def normalise_text(text):
+    """
+    Collapse runs of spaces and non-breaking spaces into a single space, in
+    one pass.
+
+    >>> normalise_text("Route\\xa0X50  13:00 \\xa0outbound")
+    'Route X50 13:00 outbound'
+    """
+    return WHITESPACE.sub(" ", text)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_time_pattern(time):
+    """
+    Fold all of the variations of a time into a single regex. Returns None if
+    any variation is empty, because an empty variation is in every line.
+    """
+    variations = [""] if time is None else time_variations(time)
+    if "" in variations:
+        return None
+    return re.compile("|".join(re.escape(v.lower()) for v in sorted(set(variations))))
+
+
+class AlertMatcher:
+    """
+    One compiled matcher per distinct (route, time, direction), shared by every
+    alert with that signature. The route and direction are lowercased up front
+    and time_pattern folds the time variations into a single regex, which is
+    None for alerts without a time. AlertIndex only searches with it for times
+    that aren't made of digits and colons, the rest are looked up by variation.
+    """
+
+    __slots__ = ("route", "direction", "time_pattern", "alerts")
+
+    def __init__(self, route, time, direction):
+        self.route = (route or "").lower()
+        self.direction = (direction or "").lower()
+        self.time_pattern = compile_time_pattern(time)
+        # (position, alert) pairs in the order the alerts were indexed
+        self.alerts = []
+
+
+class _RouteGroup:
+    __slots__ = ("any_time", "by_variation", "by_pattern")
+
+    def __init__(self):
+        # matchers without a time
+        self.any_time = []
+        # time variation made of digits and colons -> [AlertMatcher]
+        self.by_variation = {}
+        # anything else is searched for with its compiled pattern
+        self.by_pattern = []
+
+
+TIME_RUN = re.compile(r"[0-9:]+")
+
+
+class AlertIndex:
+    """
+    In-memory index of alerts, built once per scrape, so that each line of an
+    article is only compared against the alerts that could possibly match it.
+
+    Alerts are compiled into AlertMatchers keyed by their lowercased route and
+    then by every time variation. Each line is tokenised once into the
+    substrings of its runs of digits and colons, which are looked up directly.
+    A time variation made of those characters can only be in a line inside
+    such a run, so the matches are exactly the same as checking every alert
+    with includes() and time_variations(). Any other time, such as "noon", is
+    searched for with its matcher's compiled regex.
+
+    >>> import types
+    >>> alerts = [
+    ...     types.SimpleNamespace(id=1, user_id=1, route="X50", time="13:00", direction="OUT"),
+    ...     types.SimpleNamespace(id=2, user_id=2, route="X5", time="", direction=""),
+    ...     types.SimpleNamespace(id=3, user_id=3, route="", time="9:05", direction="in"),
+    ...     types.SimpleNamespace(id=4, user_id=4, route="x50", time="13:00", direction="out"),
+    ...     types.SimpleNamespace(id=5, user_id=5, route="", time="noon", direction=""),
+    ... ]
+    >>> index = AlertIndex(alerts)
+    >>> [a.id for a in index.match("Route X50 13:00 outbound cancelled")]
+    [1, 2, 4]
+    >>> [a.id for a in index.match("Route 401 0905 inbound cancelled at noon")]
+    [3, 5]
+    >>> [a.id for a in index.match("X50 13:00 outbound cancelled")]
+    []
+    """
+
+    def __init__(self, alerts):
+        # route -> _RouteGroup
+        self._routes = {}
+        # lengths of the time variations in by_variation
+        self._variation_lengths = set()
+        matchers = {}
+        self._count = 0
+        for position, alert in enumerate(alerts):
+            key = (
+                (alert.route or "").lower(),
+                alert.time,
+                (alert.direction or "").lower(),
+            )
+            matcher = matchers.get(key)
+            if matcher is None:
+                matcher = AlertMatcher(alert.route, alert.time, alert.direction)
+                matchers[key] = matcher
+                self._add(matcher, alert.time)
+            matcher.alerts.append((position, alert))
+            self._count += 1
+
+    def _add(self, matcher, time):
+        group = self._routes.get(matcher.route)
+        if group is None:
+            group = self._routes[matcher.route] = _RouteGroup()
+
+        if matcher.time_pattern is None:
+            group.any_time.append(matcher)
+            return
+
+        variations = {v.lower() for v in time_variations(time)}
+        if all(TIME_RUN.fullmatch(v) for v in variations):
+            for variation in variations:
+                group.by_variation.setdefault(variation, []).append(matcher)
+                self._variation_lengths.add(len(variation))
+        else:
+            group.by_pattern.append(matcher)
+
+    def __len__(self):
+        return self._count
+
+    def _time_tokens(self, text):
+        tokens = set()
+        for run in TIME_RUN.findall(text):
+            for length in self._variation_lengths:
+                for start in range(len(run) - length + 1):
+                    tokens.add(run[start : start + length])
+        return tokens
+
+    def match(self, text):
+        """Return the alerts matching a line, in the order they were indexed."""
+        text = text.lower()
+        if "route" not in text:
+            return []
+
+        tokens = None
+        matched = {}
+        for route, group in self._routes.items():
+            if route not in text:
+                continue
+
+            candidates = list(group.any_time)
+            if group.by_variation:
+                if tokens is None:
+                    tokens = self._time_tokens(text)
+                for token in tokens:
+                    candidates += group.by_variation.get(token, ())
+            for matcher in group.by_pattern:
+                if matcher.time_pattern.search(text):
+                    candidates.append(matcher)
+
+            for matcher in candidates:
+                if matcher.direction in text:
+                    matched[id(matcher)] = matcher.alerts
+
+        pairs = []
+        for alerts in matched.values():
+            pairs += alerts
+        if len(matched) > 1:
+            pairs.sort(key=operator.itemgetter(0))
+        return [alert for _, alert in pairs]
@@ -0,0 +1,984 @@
+"""
+Benchmarks for the hot paths of the bot and scraper.
+
+    python benchmark.py queries --rows 1000000
+    python benchmark.py latency --rows 200000
+    python benchmark.py wakeup
+    python benchmark.py parse
+    python benchmark.py match --alerts 10000 --lines 500
+    python benchmark.py claim --workers 8 --database-url postgresql+psycopg://...
+    python benchmark.py delivery --workers 4 --partitions 2
+    python benchmark.py fetch
+    python benchmark.py flaky
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import glob
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp.web
+import bs4
+import sqlalchemy
+
+import DatabaseController
+import alert_index
+import http_client
+import notification_dispatcher
+import scraper
+import wakeup
+
+
+def timeit(function, repeat=20):
+    """Return the median run time of function in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def fill_database(database_controller, rows, users=10000, unsent_fraction=0.001):
+    engine = database_controller._engine
+    with engine.begin() as connection:
+        batch = []
+        for i in range(rows):
+            batch.append(
+                {
+                    "hash": DatabaseController.notification_hash(
+                        "benchmark", str(i), i % users
+                    ),
+                    "heading": "Service Update",
+                    "text": f"Route X{i % 100} {i % 24}:00 outbound cancelled",
+                    "recipient": str(i % users),
+                    "sent": random.random() >= unsent_fraction,
+                }
+            )
+            if len(batch) == 50000:
+                connection.execute(
+                    DatabaseController.Notification.__table__.insert(), batch
+                )
+                batch = []
+        if batch:
+            connection.execute(
+                DatabaseController.Notification.__table__.insert(), batch
+            )
+
+        connection.execute(
+            DatabaseController.Alert.__table__.insert(),
+            [
+                {
+                    "user_id": i % users,
+                    "route": f"X{i % 100}",
+                    "time": "",
+                    "direction": "",
+                }
+                for i in range(users * 5)
+            ],
+        )
+        connection.execute(
+            DatabaseController.Preference.__table__.insert(),
+            [
+                {"user_id": i, "key": "delivery_method", "value": "discord_DM"}
+                for i in range(users)
+            ],
+        )
+
+
+def benchmark_queries(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        database_controller = DatabaseController.DatabaseController(
+            "sqlite:///" + os.path.join(directory, "benchmark.db")
+        )
+        start = time.perf_counter()
+        fill_database(database_controller, rows)
+        print(f"filled {rows} notification rows in {time.perf_counter() - start:.1f}s")
+
+        def preference_uncached():
+            database_controller._preference_cache.clear()
+            database_controller.get_user_preference(
+                random.randrange(10000), "delivery_method"
+            )
+
+        queries = {
+            "get_pending_notifications": database_controller.get_pending_notifications,
+            "get_alerts(user_id)": lambda: database_controller.get_alerts(
+                random.randrange(10000)
+            ),
+            "get_user_preference (uncached)": preference_uncached,
+            "get_user_preference (cached)": lambda: database_controller.get_user_preference(
+                1, "delivery_method"
+            ),
+        }
+
+        indexed = {name: timeit(query) for name, query in queries.items()}
+
+        with database_controller._engine.begin() as connection:
+            connection.execute(sqlalchemy.text("DROP INDEX ix_notifications_unsent"))
+            connection.execute(sqlalchemy.text("DROP INDEX ix_alerts_user_id"))
+        unindexed = {name: timeit(query, repeat=5) for name, query in queries.items()}
+
+        print(f"{'query':<34}{'no index (ms)':>16}{'indexed (ms)':>16}")
+        for name in queries:
+            print(f"{name:<34}{unindexed[name]:>16.2f}{indexed[name]:>16.2f}")
+
+
+# Discord fails an interaction that isn't responded to within this long
+INTERACTION_DEADLINE_MS = 3000
+
+
+async def measure_interactions(database_controller, write):
+    """
+    Run write while simulating interactions every 10ms: an alerts embed
+    lookup, and a preference change answered the way discord_bot.py does,
+    deferred before its write. Returns the lookup latencies, the time each
+    interaction took to respond, the preference write times and the worst
+    event loop lag, all in ms.
+    """
+    reads = []
+    responses = []
+    writes = []
+    max_lag = 0
+
+    async def call(method, *args):
+        result = getattr(database_controller, method)(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def change_preference(due):
+        # interaction.response.defer() goes here
+        responses.append((time.perf_counter() - due) * 1000)
+        start = time.perf_counter()
+        await call(
+            "set_user_preference",
+            random.randrange(10000),
+            "delivery_method",
+            "discord_DM",
+        )
+        writes.append((time.perf_counter() - start) * 1000)
+
+    write_task = asyncio.ensure_future(write())
+    # one preference change at a time, as a burst would also queue behind
+    # the lookups for the executor's threads
+    change_task = None
+    while not write_task.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        due = start + 0.01
+        max_lag = max(max_lag, (time.perf_counter() - due) * 1000)
+
+        if change_task is None or change_task.done():
+            change_task = asyncio.ensure_future(change_preference(due))
+
+        start = time.perf_counter()
+        await call("get_alerts", random.randrange(10000))
+        reads.append((time.perf_counter() - start) * 1000)
+        responses.append((time.perf_counter() - due) * 1000)
+    await write_task
+    await change_task
+    return reads, responses, writes, max_lag
+
+
+def benchmark_latency(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        database_controller = DatabaseController.DatabaseController(
+            "sqlite:///" + os.path.join(directory, "benchmark.db")
+        )
+        fill_database(database_controller, 10000)
+        async_database_controller = DatabaseController.AsyncDatabaseController(
+            database_controller
+        )
+
+        def notifications(run):
+            return [
+                {
+                    "recipient": i % 10000,
+                    "text": "x",
+                    "hash": DatabaseController.notification_hash(run, str(i), i),
+                }
+                for i in range(rows)
+            ]
+
+        async def blocking_write():
+            database_controller.send_notifications(notifications("blocking"))
+
+        async def executor_write():
+            await async_database_controller.send_notifications(
+                notifications("executor")
+            )
+
+        print(f"interactions while bulk inserting {rows} notifications")
+        print(
+            f"{'controller':<24}{'lookup p50':>12}{'lookup max':>12}"
+            f"{'write max':>12}{'respond max':>13}{'loop lag':>10}  (ms)"
+        )
+        for name, controller, write in [
+            ("DatabaseController", database_controller, blocking_write),
+            ("AsyncDatabaseController", async_database_controller, executor_write),
+        ]:
+            reads, responses, writes, max_lag = asyncio.run(
+                measure_interactions(controller, write)
+            )
+            print(
+                f"{name:<24}{statistics.median(reads):>12.2f}{max(reads):>12.2f}"
+                f"{max(writes):>12.2f}{max(responses):>13.2f}{max_lag:>10.2f}"
+            )
+        # with the AsyncDatabaseController, the last run, the preference
+        # writes still wait for the bulk insert to commit, but they are
+        # deferred so every interaction responds in time
+        assert max(responses) < INTERACTION_DEADLINE_MS
+
+
+class FakeDestination:
+    def __init__(self, id, on_send):
+        self.id = id
+        self.name = str(id)
+        self._on_send = on_send
+
+    async def send(self, content):
+        self._on_send(content)
+
+    async def history(self, limit=100):
+        for message in []:
+            yield message
+
+
+class FakeClient:
+    """The parts of discord.Client that NotificationDispatcher uses."""
+
+    user = "bot"
+
+    def __init__(self, on_send):
+        self._on_send = on_send
+
+    def get_all_channels(self):
+        return []
+
+    def get_user(self, user_id):
+        return FakeDestination(user_id, self._on_send)
+
+
+def benchmark_wakeup(matches):
+    async def run(directory):
+        database_controller = DatabaseController.DatabaseController(
+            "sqlite:///" + os.path.join(directory, "benchmark.db")
+        )
+        async_database_controller = DatabaseController.AsyncDatabaseController(
+            database_controller
+        )
+        notifier = wakeup.Wakeup()
+        database_controller.notification_listeners.append(notifier.notify)
+
+        sent = asyncio.Queue()
+        dispatcher = notification_dispatcher.NotificationDispatcher(
+            FakeClient(lambda content: sent.put_nowait(time.perf_counter())),
+            async_database_controller,
+            guild_id=None,
+        )
+
+        async def deliver_forever():
+            while True:
+                await notifier.wait(120)
+                await dispatcher.dispatch()
+
+        delivery = asyncio.ensure_future(deliver_forever())
+        latencies = []
+        for i in range(matches):
+            start = time.perf_counter()
+            await async_database_controller.send_notifications(
+                [
+                    {
+                        "recipient": i,
+                        "text": "Route X50 cancelled",
+                        "hash": DatabaseController.notification_hash("wakeup", "", i),
+                    }
+                ]
+            )
+            latencies.append((await sent.get() - start) * 1000)
+        delivery.cancel()
+        return latencies
+
+    with tempfile.TemporaryDirectory() as directory:
+        latencies = asyncio.run(run(directory))
+    print(f"match to send latency over {matches} matches (safety net poll is 120s)")
+    print(f"p50 {statistics.median(latencies):.2f}ms, " f"max {max(latencies):.2f}ms")
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def parse_alerts_index_full_tree(content):
+    """The alerts index parser from before SoupStrainer, for comparison."""
+    soup = bs4.BeautifulSoup(content, "html.parser")
+    articles = soup.find("div", {"class": "article-body col-md-9"})
+    parsed = []
+    for article in articles.findAll("article"):
+        date = datetime.datetime.fromisoformat(article.find("time").attrs["datetime"])
+        title = article.find("h4").text
+        url = article.find("a").attrs["href"]
+        description = article.find("p").text
+        if description == "":
+            description = None
+        location = article.find("span").text
+        parsed.append((date, title, url, description, location))
+    return parsed
+
+
+def parse_article_full_tree(content):
+    """The article parser from before SoupStrainer, for comparison."""
+    soup = bs4.BeautifulSoup(content, "html.parser")
+    article = soup.find("article")
+    lines = []
+    for paragraph in article.findAll("p"):
+        text = re.sub(r" +", " ", paragraph.text.replace("\xa0", " "))
+        lines += text.split("\n")
+    return lines
+
+
+def peak_memory(function):
+    """Return the peak memory allocated while running function in KiB."""
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def benchmark_parse():
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.html"))):
+        with open(path, "rb") as file:
+            content = file.read()
+        if os.path.basename(path) == "alerts.html":
+            pages.append(
+                (
+                    "alerts index",
+                    content,
+                    parse_alerts_index_full_tree,
+                    scraper.parse_alerts_index,
+                )
+            )
+        else:
+            pages.append(
+                (
+                    os.path.basename(path),
+                    content,
+                    parse_article_full_tree,
+                    scraper.parse_article,
+                )
+            )
+
+    print(
+        f"{'page':<40}{'full (ms)':>11}{'lean (ms)':>11}"
+        f"{'full (KiB)':>12}{'lean (KiB)':>12}"
+    )
+    for name, content, full, lean in pages:
+        # the lean parser must give exactly the same output
+        assert full(content) == lean(content), name
+        print(
+            f"{name:<40}"
+            f"{timeit(lambda: full(content)):>11.2f}"
+            f"{timeit(lambda: lean(content)):>11.2f}"
+            f"{peak_memory(lambda: full(content)):>12.0f}"
+            f"{peak_memory(lambda: lean(content)):>12.0f}"
+        )
+
+
+class SyntheticAlert:
+    def __init__(self, id, route, time, direction):
+        self.id = id
+        self.user_id = id
+        self.route = route
+        self.time = time
+        self.direction = direction
+
+
+def synthetic_alerts(count):
+    routes = [f"X{i}" for i in range(1, 80)] + [str(i) for i in range(401, 480)]
+    alerts = []
+    for i in range(count):
+        alerts.append(
+            SyntheticAlert(
+                i,
+                random.choice(routes + [""]),
+                random.choice(
+                    [f"{random.randint(5, 23)}:{random.randrange(0, 60, 5):02}", ""]
+                ),
+                random.choice(["in", "out", ""]),
+            )
+        )
+    return alerts
+
+
+def synthetic_lines(count):
+    routes = [f"X{i}" for i in range(1, 80)] + [str(i) for i in range(401, 480)]
+    lines = []
+    for _ in range(count):
+        lines.append(
+            f"Route {random.choice(routes)}\xa0 {random.randint(5, 23)}:"
+            f"{random.randrange(0, 60, 5):02} {random.choice(['inbound', 'outbound'])}"
+            "  trip from Hobart Interchange is cancelled."
+        )
+    return lines
+
+
+def awkward_alerts(count):
+    """
+    Alerts with the odd routes, times and directions users can type. NewAlert
+    only accepts times with one colon.
+    """
+    return [
+        SyntheticAlert(
+            i,
+            random.choice(["X50", "x5", "50", "501", "401", "", "X"]),
+            random.choice(
+                ["13:00", "1:00", "9:05", "09:05", "13:0", ":5", ":", "no:on", ""]
+            ),
+            random.choice(["in", "out", "IN", "Out", ""]),
+        )
+        for i in range(count)
+    ]
+
+
+def awkward_lines(count):
+    """Lines with times and routes run together, odd case and spacing."""
+    words = [
+        "Route",
+        "route",
+        "ROUTE",
+        "X50",
+        "x5",
+        "501",
+        "50",
+        "13:00",
+        "1300",
+        "1:00",
+        "100",
+        "9:05",
+        "0905",
+        "905",
+        "19:05",
+        "113:001",
+        "inbound",
+        "outbound",
+        "NOON",
+        "cancelled",
+        ":",
+        "9",
+    ]
+    return [
+        "".join(
+            random.choice(words) + random.choice([" ", " ", "", "\xa0", "-"])
+            for _ in range(random.randint(1, 10))
+        )
+        for _ in range(count)
+    ]
+
+
+def match_every_alert(alerts, lines):
+    """The matching loop from before AlertIndex, for comparison."""
+    matches = []
+    for text in lines:
+        for alert in alerts:
+            if (
+                alert_index.includes("route", text)
+                and alert_index.includes(alert.route, text)
+                and alert_index.includes(alert.direction, text)
+                and any(
+                    alert_index.includes(t, text)
+                    for t in alert_index.time_variations(alert.time)
+                )
+            ):
+                matches.append(alert)
+    return matches
+
+
+def match_with_index(alerts, lines):
+    index = alert_index.AlertIndex(alerts)
+    matches = []
+    for text in lines:
+        matches += index.match(text)
+    return matches
+
+
+def benchmark_match(alert_count, line_count):
+    random.seed(0)
+    alerts = synthetic_alerts(alert_count)
+    raw_lines = synthetic_lines(line_count)
+
+    def normalise_two_pass():
+        return [re.sub(r" +", " ", line.replace("\xa0", " ")) for line in raw_lines]
+
+    def normalise_one_pass():
+        return [alert_index.normalise_text(line) for line in raw_lines]
+
+    lines = normalise_one_pass()
+    assert lines == normalise_two_pass()
+    assert match_every_alert(alerts, lines) == match_with_index(alerts, lines)
+
+    # the index has to match exactly what includes() does, awkward input too
+    awkward = awkward_alerts(300)
+    index = alert_index.AlertIndex(awkward)
+    corpus = awkward_lines(5000)
+    mismatches = sum(
+        1 for line in corpus if match_every_alert(awkward, [line]) != index.match(line)
+    )
+    matched = sum(1 for line in corpus if index.match(line))
+    print(
+        f"{len(corpus)} random lines ({matched} matching) against "
+        f"{len(awkward)} random alerts: {mismatches} differ from includes()"
+    )
+    assert mismatches == 0
+
+    print(f"{alert_count} alerts x {line_count} lines")
+    print(f"{'stage':<44}{'before (ms)':>14}{'after (ms)':>14}")
+    for name, before, after in [
+        ("normalise lines", normalise_two_pass, normalise_one_pass),
+        (
+            "match (includes loop -> compiled AlertIndex)",
+            lambda: match_every_alert(alerts, lines),
+            lambda: match_with_index(alerts, lines),
+        ),
+    ]:
+        print(f"{name:<44}{timeit(before, 3):>14.2f}{timeit(after, 3):>14.2f}")
+
+
+def benchmark_claim(database_url, workers, rows):
+    """
+    Queue rows notifications from one thread while workers threads claim and
+    mark them sent, then check every notification was claimed exactly once.
+    database_url must be a scratch database, its tables are emptied.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        if database_url is None:
+            database_url = "sqlite:///" + os.path.join(directory, "benchmark.db")
+        engine = sqlalchemy.create_engine(database_url)
+        DatabaseController.Base.metadata.drop_all(engine)
+        engine.dispose()
+        database_controller = DatabaseController.DatabaseController(
+            database_url, pool_size=workers + 1
+        )
+
+        queued = concurrent.futures.Future()
+        claims = collections.Counter()
+
+        def queue():
+            for i in range(0, rows, 500):
+                database_controller.send_notifications(
+                    {
+                        "recipient": j % 1000,
+                        "text": f"Route X50 cancelled {j}",
+                        "hash": DatabaseController.notification_hash(
+                            "claim", str(j), j
+                        ),
+                    }
+                    for j in range(i, min(i + 500, rows))
+                )
+            queued.set_result(True)
+
+        def deliver():
+            while True:
+                done = queued.done()
+                claimed = database_controller.claim_pending_notifications()
+                if not claimed:
+                    if done:
+                        return
+                    time.sleep(0.001)
+                    continue
+                claims.update(notification.id for notification in claimed)
+                database_controller.mark_notifications_sent(
+                    [notification.id for notification in claimed]
+                )
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(workers + 1) as executor:
+            futures = [executor.submit(queue)]
+            futures += [executor.submit(deliver) for _ in range(workers)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        database_controller._engine.dispose()
+
+    duplicates = sum(1 for count in claims.values() if count > 1)
+    print(f"{engine.dialect.name}, {workers} workers, {rows} notifications")
+    print(f"claimed {len(claims)}, claimed more than once {duplicates}")
+    print(f"{rows / elapsed:.0f} notifications per second")
+    assert len(claims) == rows and duplicates == 0
+
+
+def benchmark_delivery(database_url, workers, partitions, notifications):
+    """
+    Run workers dispatchers, each with its own database controller as if they
+    were separate processes, spread over partitions while notifications are
+    queued. A worker that claims a batch and then dies is simulated too. Checks
+    every notification is delivered exactly once, by a dispatcher of the right
+    partition.
+    """
+
+    async def run(database_url):
+        controllers = [
+            DatabaseController.DatabaseController(database_url) for _ in range(workers)
+        ]
+        delivered = collections.Counter()
+        wrong_partition = []
+
+        def on_send(partition):
+            def record(content):
+                for line in content.split("\n"):
+                    if line.startswith("notification "):
+                        recipient = int(line.rsplit(" ", 1)[1])
+                        delivered[line] += 1
+                        if recipient % partitions != partition:
+                            wrong_partition.append(line)
+
+            return record
+
+        dispatchers = [
+            notification_dispatcher.NotificationDispatcher(
+                FakeClient(on_send(i % partitions)),
+                DatabaseController.AsyncDatabaseController(controller),
+                guild_id=None,
+                global_rate=1000000,
+                partition=i % partitions,
+                partitions=partitions,
+                worker_id=f"worker-{i}",
+                claim_size=200,
+            )
+            for i, controller in enumerate(controllers)
+        ]
+
+        queued = False
+
+        async def queue():
+            nonlocal queued
+            producer = DatabaseController.AsyncDatabaseController(controllers[0])
+            for i in range(0, notifications, 250):
+                await producer.send_notifications(
+                    {
+                        "recipient": j % 1000,
+                        "text": f"notification {j} for {j % 1000}",
+                        "hash": DatabaseController.notification_hash(
+                            "delivery", str(j), j % 1000
+                        ),
+                    }
+                    for j in range(i, min(i + 250, notifications))
+                )
+                if i == 0:
+                    # a worker claims the first batch and dies without sending
+                    controllers[0].claim_pending_notifications(
+                        lease_seconds=2, worker_id="crashed", limit=100
+                    )
+            queued = True
+
+        async def deliver(dispatcher, controller):
+            while True:
+                done = queued
+                await dispatcher.dispatch()
+                if done and controller.count_pending_notifications() == 0:
+                    return
+                await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            queue(),
+            *(
+                deliver(dispatcher, controller)
+                for dispatcher, controller in zip(dispatchers, controllers)
+            ),
+        )
+        elapsed = time.perf_counter() - start
+        for controller in controllers:
+            controller._engine.dispose()
+        return delivered, wrong_partition, elapsed
+
+    with tempfile.TemporaryDirectory() as directory:
+        if database_url is None:
+            database_url = "sqlite:///" + os.path.join(directory, "benchmark.db")
+        engine = sqlalchemy.create_engine(database_url)
+        DatabaseController.Base.metadata.drop_all(engine)
+        engine.dispose()
+        delivered, wrong_partition, elapsed = asyncio.run(run(database_url))
+
+    twice = sum(1 for count in delivered.values() if count > 1)
+    print(
+        f"{workers} workers over {partitions} partitions, {notifications} notifications"
+    )
+    print(
+        f"delivered {len(delivered)}, more than once {twice}, "
+        f"by the wrong partition {len(wrong_partition)}, in {elapsed:.1f}s "
+        "(including a 2s lease held by a crashed worker)"
+    )
+    assert len(delivered) == notifications and twice == 0 and not wrong_partition
+
+
+class SlowServer:
+    """
+    Local HTTP stub listening on hosts ports, so it looks like that many
+    hosts, that takes delay seconds to answer. Records when each request to
+    each host started, the most requests in flight at once across all of
+    them and the connections used.
+    """
+
+    def __init__(self, delay, hosts=2):
+        self.delay = delay
+        self.hosts = hosts
+        # base url -> request start times
+        self.started = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = set()
+        self.base_urls = []
+        self._runner = None
+
+    async def _handle(self, request):
+        self.started[f"http://{request.host}"].append(time.monotonic())
+        self.connections.add(request.transport.get_extra_info("peername"))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return aiohttp.web.Response(text=f"page {request.path}")
+
+    async def __aenter__(self):
+        app = aiohttp.web.Application()
+        app.router.add_get("/{path:.*}", self._handle)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        for _ in range(self.hosts):
+            await aiohttp.web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        for host, port in self._runner.addresses:
+            self.base_urls.append(f"http://{host}:{port}")
+            self.started[self.base_urls[-1]] = []
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._runner.cleanup()
+
+
+def benchmark_fetch(pages, max_concurrency, min_interval):
+    """
+    Fetch pages from each of two slow local hosts at once, checking the
+    fetcher keeps at most max_concurrency requests in flight, spaces out
+    requests to each host by min_interval and reuses its connections.
+    """
+
+    async def run():
+        async with SlowServer(0.1) as server, http_client.Fetcher(
+            max_concurrency=max_concurrency, min_interval=min_interval
+        ) as fetcher:
+            start = time.perf_counter()
+            bodies = await asyncio.gather(
+                *(
+                    fetcher.get(f"{base_url}/{i}")
+                    for i in range(pages)
+                    for base_url in server.base_urls
+                )
+            )
+            elapsed = time.perf_counter() - start
+        return server, bodies, elapsed
+
+    server, bodies, elapsed = asyncio.run(run())
+    assert bodies == [
+        f"page /{i}".encode() for i in range(pages) for _ in server.base_urls
+    ]
+
+    gaps = [
+        later - earlier
+        for started in server.started.values()
+        for earlier, later in zip(started, started[1:])
+    ]
+    print(
+        f"{pages} pages from each of {server.hosts} hosts in {elapsed:.2f}s, "
+        f"max_concurrency {max_concurrency}, min_interval {min_interval * 1000:.0f}ms"
+    )
+    print(
+        f"most in flight {server.max_in_flight}, smallest gap between requests "
+        f"to a host {min(gaps) * 1000:.1f}ms, {len(server.connections)} connections"
+    )
+    assert server.max_in_flight <= max_concurrency
+    # allow for the timer resolution
+    assert min(gaps) >= min_interval - 0.005
+    # kept alive and reused, at most max_concurrency to each host rather than
+    # one per request
+    assert len(server.connections) <= max_concurrency * server.hosts
+
+
+class FlakyServer:
+    """
+    Local HTTP stub that fails the first failures requests for each path,
+    alternately with a 503 and by dropping the connection, or every request
+    while down is set.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.down = False
+        self.requests = collections.Counter()
+        self.base_url = None
+        self._runner = None
+
+    async def _handle(self, request):
+        self.requests[request.path] += 1
+        count = self.requests[request.path]
+        if self.down or count <= self.failures:
+            if count % 2:
+                return aiohttp.web.Response(status=503)
+            request.transport.close()
+            return aiohttp.web.Response()
+        return aiohttp.web.Response(text=f"page {request.path}")
+
+    async def __aenter__(self):
+        app = aiohttp.web.Application()
+        app.router.add_get("/{path:.*}", self._handle)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._runner.cleanup()
+
+
+def benchmark_flaky(pages, failures):
+    """
+    Fetch pages that each fail failures times before working, then a site
+    that is down, to check the retries and the circuit breaker.
+    """
+
+    async def run():
+        breaker = http_client.CircuitBreaker(failure_threshold=3, reset_timeout=1)
+        async with FlakyServer(failures) as server, http_client.Fetcher(
+            min_interval=0, retries=failures, backoff_base=0.05, breaker=breaker
+        ) as fetcher:
+            start = time.perf_counter()
+            bodies = await asyncio.gather(
+                *(fetcher.get(f"{server.base_url}/{i}") for i in range(pages))
+            )
+            elapsed = time.perf_counter() - start
+            assert bodies == [f"page /{i}".encode() for i in range(pages)]
+            print(
+                f"{pages} pages failing {failures} times each: all fetched with "
+                f"{sum(server.requests.values())} requests in {elapsed:.2f}s"
+            )
+
+            server.down = True
+            server.requests.clear()
+            outcomes = collections.Counter()
+            start = time.perf_counter()
+            for i in range(pages):
+                try:
+                    await fetcher.get(f"{server.base_url}/down/{i}")
+                    outcomes["fetched"] += 1
+                except http_client.CircuitOpenError:
+                    outcomes["circuit open"] += 1
+                except Exception:
+                    outcomes["failed"] += 1
+            elapsed = time.perf_counter() - start
+            print(
+                f"site down, {pages} fetches: {dict(outcomes)}, "
+                f"{sum(server.requests.values())} requests in {elapsed:.2f}s"
+            )
+            assert outcomes["failed"] == breaker.failure_threshold
+            assert outcomes["circuit open"] == pages - breaker.failure_threshold
+
+            server.down = False
+            await asyncio.sleep(breaker.reset_timeout)
+            body = await fetcher.get(f"{server.base_url}/recovered")
+            await fetcher.get(f"{server.base_url}/recovered")
+            print(f"site back up after {breaker.reset_timeout}s: fetched again")
+            assert body == b"page /recovered"
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    queries = subparsers.add_parser("queries", help="database query latency")
+    queries.add_argument("--rows", type=int, default=1000000)
+
+    latency = subparsers.add_parser(
+        "latency", help="interaction latency during a bulk write"
+    )
+    latency.add_argument("--rows", type=int, default=200000)
+
+    wakeup_parser = subparsers.add_parser(
+        "wakeup", help="latency from a scrape match to its delivery"
+    )
+    wakeup_parser.add_argument("--matches", type=int, default=100)
+
+    subparsers.add_parser("parse", help="HTML parse time and peak memory")
+
+    match = subparsers.add_parser("match", help="alert matching throughput")
+    match.add_argument("--alerts", type=int, default=10000)
+    match.add_argument("--lines", type=int, default=500)
+
+    claim = subparsers.add_parser(
+        "claim", help="concurrent dispatchers claiming pending notifications"
+    )
+    claim.add_argument("--database-url", help="a scratch database, default SQLite")
+    claim.add_argument("--workers", type=int, default=8)
+    claim.add_argument("--rows", type=int, default=20000)
+
+    delivery = subparsers.add_parser(
+        "delivery", help="exactly once delivery with several dispatchers"
+    )
+    delivery.add_argument("--database-url", help="a scratch database, default SQLite")
+    delivery.add_argument("--workers", type=int, default=4)
+    delivery.add_argument("--partitions", type=int, default=2)
+    delivery.add_argument("--notifications", type=int, default=5000)
+
+    fetch = subparsers.add_parser(
+        "fetch", help="concurrency and per host spacing against slow servers"
+    )
+    fetch.add_argument("--pages", type=int, default=20)
+    fetch.add_argument("--max-concurrency", type=int, default=4)
+    fetch.add_argument("--min-interval", type=float, default=0.02)
+
+    flaky = subparsers.add_parser(
+        "flaky", help="retries and the circuit breaker against a flaky server"
+    )
+    flaky.add_argument("--pages", type=int, default=20)
+    flaky.add_argument("--failures", type=int, default=2)
+
+    args = parser.parse_args()
+    if args.benchmark == "queries":
+        benchmark_queries(args.rows)
+    elif args.benchmark == "latency":
+        benchmark_latency(args.rows)
+    elif args.benchmark == "wakeup":
+        benchmark_wakeup(args.matches)
+    elif args.benchmark == "parse":
+        benchmark_parse()
+    elif args.benchmark == "match":
+        benchmark_match(args.alerts, args.lines)
+    elif args.benchmark == "claim":
+        benchmark_claim(args.database_url, args.workers, args.rows)
+    elif args.benchmark == "delivery":
+        benchmark_delivery(
+            args.database_url, args.workers, args.partitions, args.notifications
+        )
+    elif args.benchmark == "fetch":
+        benchmark_fetch(args.pages, args.max_concurrency, args.min_interval)
+    elif args.benchmark == "flaky":
+        benchmark_flaky(args.pages, args.failures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Delivers notifications from its own process, so delivery can be spread over
+more than one process. Recipients are split between DELIVERY_PARTITIONS
+processes by user id: the bot delivers partition 0 and each worker is started
+with one of the others.
+
+    DELIVERY_PARTITIONS=2 WAKEUP_PEERS=127.0.0.1:8775 python discord_bot.py TOKEN
+    DELIVERY_PARTITIONS=2 python delivery_worker.py TOKEN --partition 1 \
+        --wakeup-address 127.0.0.1:8775 --metrics-address 127.0.0.1:8776
+    WAKEUP_ADDRESS=127.0.0.1:8765,127.0.0.1:8775 python scraper_worker.py
+
+Only the bot connects to the gateway, so interactions are still handled once.
+Workers use the HTTP API and listen for wakeups on --wakeup-address, which
+can't be the bot's WAKEUP_ADDRESS (127.0.0.1:8765 by default) on the same
+host; give the scraper worker (and the bot, as WAKEUP_PEERS) a comma separated
+list with every worker's address. Metrics are only served with
+--metrics-address. Anything claimed by a worker that dies is picked up again
+once its lease expires.
+"""
+
+import argparse
+import asyncio
+import os
+import traceback
+
+import discord
+
+import DatabaseController
+import metrics
+import notification_dispatcher
+import wakeup
+
+
+# the same guild as discord_bot.TEST_GUILD
+GUILD_ID = 1150694755618009168
+
+# how often to check for notifications if no wakeup was received
+SAFETY_NET_POLL_SECONDS = 120
+
+
+async def run(token, partition, partitions, wakeup_address, metrics_address):
+    sync_database_controller = DatabaseController.DatabaseController(
+        DatabaseController.DATABASE_URL
+    )
+    database_controller = DatabaseController.AsyncDatabaseController(
+        sync_database_controller
+    )
+
+    client = discord.Client(intents=discord.Intents.none(), max_ratelimit_timeout=30)
+    # logs in to the HTTP API without connecting to the gateway
+    await client.login(token)
+
+    dispatcher = notification_dispatcher.NotificationDispatcher(
+        client,
+        database_controller,
+        GUILD_ID,
+        max_workers=8,
+        partition=partition,
+        partitions=partitions,
+    )
+    notifier = wakeup.Wakeup()
+    sync_database_controller.notification_listeners.append(notifier.notify)
+    await notifier.listen(wakeup_address)
+    metrics.add_collector(dispatcher.count_pending)
+    await metrics.serve(metrics_address)
+
+    print(
+        f"delivery_worker.py: delivering partition {partition} of {partitions} "
+        f"as {dispatcher.worker_id}"
+    )
+    try:
+        while True:
+            try:
+                await dispatcher.dispatch()
+            except Exception:
+                traceback.print_exc()
+            await notifier.wait(SAFETY_NET_POLL_SECONDS)
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Deliver one partition of notifications."
+    )
+    parser.add_argument("token")
+    parser.add_argument("--partition", type=int, required=True)
+    parser.add_argument(
+        "--partitions", type=int, default=notification_dispatcher.DELIVERY_PARTITIONS
+    )
+    # no defaults, the bot already uses wakeup.py's and metrics.py's
+    parser.add_argument(
+        "--wakeup-address",
+        default=os.environ.get("WAKEUP_ADDRESS"),
+        help="host:port to listen for wakeups on, default WAKEUP_ADDRESS",
+    )
+    parser.add_argument(
+        "--metrics-address",
+        default=os.environ.get("METRICS_ADDRESS", ""),
+        help="host:port to serve metrics on, default METRICS_ADDRESS or none",
+    )
+    args = parser.parse_args()
+    if not 0 <= args.partition < args.partitions:
+        parser.error("--partition must be less than --partitions")
+    if not args.wakeup_address:
+        parser.error(
+            "--wakeup-address (or WAKEUP_ADDRESS) is required, and must be an "
+            "address the bot and other workers aren't listening on"
+        )
+    asyncio.run(
+        run(
+            args.token,
+            args.partition,
+            args.partitions,
+            args.wakeup_address,
+            args.metrics_address,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
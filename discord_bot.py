@@ -1,54 +1,160 @@
-import datetime
+import collections
+import functools
+import hashlib
+import json
+import math
+import os
 import traceback
 import discord
 import discord.ext.tasks
 import discord.ext.commands
 import sys
 import asyncio
-import re
+import time
 import DatabaseController
 import discord.app_commands
+import metrics
+import notification_dispatcher
+import retention
 import scraper
+import wakeup
 
-database_controller = DatabaseController.DatabaseController("sqlite:///database.db")
+
+database_controller = DatabaseController.AsyncDatabaseController(
+    DatabaseController.DatabaseController(DatabaseController.DATABASE_URL)
+)
+
+# set to 0 when scraper_worker.py is run as its own process
+SCRAPE_IN_PROCESS = os.environ.get("SCRAPE_IN_PROCESS", "1") == "1"
+
+# how often to check for notifications if no wakeup was received
+SAFETY_NET_POLL_SECONDS = 120
 
 TEST_GUILD = discord.Object(1150694755618009168)
 
+# where the signup prompt is posted
+PROMPT_CHANNEL_ID = 1150695270267486359
+
+# alerts shown per page, an embed can have at most 25 fields
+ALERTS_PER_PAGE = 10
+# users whose alerts embeds are kept, the least recently viewed are dropped
+ALERTS_EMBED_CACHE_USERS = 1000
+
+# user id -> {page: (embed, page count)}, dropped when their alerts change
+alerts_embeds = collections.OrderedDict()
+
+DISCORD_API_SECONDS = metrics.Histogram(
+    "discord_api_request_seconds",
+    "Discord HTTP API calls, including any time discord.py waits on rate limits.",
+    ["method", "route", "result"],
+)
+
+
+def instrument_http(http):
+    """Time every request the discord.py HTTP client makes."""
+    request = http.request
+
+    async def timed_request(route, *args, **kwargs):
+        start = time.perf_counter()
+        result = "ok"
+        try:
+            return await request(route, *args, **kwargs)
+        except discord.HTTPException as e:
+            result = str(e.status)
+            raise
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            DISCORD_API_SECONDS.observe(
+                time.perf_counter() - start,
+                # the unformatted path, e.g. /channels/{channel_id}/messages
+                method=route.method,
+                route=route.path,
+                result=result,
+            )
+
+    http.request = timed_request
+
 
 class SubscribeClient(discord.Client):
     def __init__(self) -> None:
         intents = discord.Intents.default()
-        super().__init__(intents=intents)
+        # long rate limits are raised so the dispatcher can retry them itself
+        super().__init__(intents=intents, max_ratelimit_timeout=30)
 
-        self.prompt_creator_schedule_lock = asyncio.Lock()
+        self.prompt_lock = asyncio.Lock()
         self.send_alerts_lock = asyncio.Lock()
         self.scrape_lock = asyncio.Lock()
 
+        self.dispatcher = notification_dispatcher.NotificationDispatcher(
+            self,
+            database_controller,
+            TEST_GUILD.id,
+            max_workers=8,
+            partition=0,
+            partitions=notification_dispatcher.DELIVERY_PARTITIONS,
+        )
+
+        self.wakeup = None
+        instrument_http(self.http)
+
         self.tree = discord.app_commands.CommandTree(self)
 
     async def on_ready(self):
         print(f"Logged in as {self.user} (ID: {self.user.id})")
-        self.prompt_creator_schedule.start()
+        self.dispatcher.recipients.warm()
         self.send_alerts.start()
-        self.scrape.start()
+        self.prune_notifications.start()
+        if SCRAPE_IN_PROCESS:
+            self.scrape.start()
         await self.change_presence(
             activity=discord.Activity(
                 type=discord.ActivityType.watching, name="for cancellations"
             )
         )
+        await self.update_prompt()
+
+    async def on_guild_channel_create(self, channel):
+        self.dispatcher.recipients.channel_created(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        self.dispatcher.recipients.channel_deleted(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        self.dispatcher.recipients.channel_updated(before, after)
 
     async def setup_hook(self) -> None:
+        self.wakeup = wakeup.Wakeup()
+        database_controller.sync.notification_listeners.append(self.wakeup.notify)
+        if wakeup.WAKEUP_PEERS:
+            database_controller.sync.notification_listeners.append(
+                functools.partial(wakeup.send_wakeup, wakeup.WAKEUP_PEERS)
+            )
+        await self.wakeup.listen()
+        # send anything left over from before a restart
+        self.wakeup.notify()
+
+        metrics.add_collector(self.dispatcher.count_pending)
+        await metrics.serve()
+
+        # the prompt's buttons keep working after a restart
+        self.add_view(PromptInitial())
+
         self.tree.copy_global_to(guild=TEST_GUILD)
         await self.tree.sync(guild=TEST_GUILD)
 
-    @discord.ext.tasks.loop(seconds=60)
-    async def prompt_creator_schedule(self):
-        if self.prompt_creator_schedule_lock.locked():
-            return
-        await self.prompt_creator_schedule_lock.acquire()
-
-        content = (
-            """# MetroTas Cancellation Alerts
+    async def update_prompt(self):
+        """
+        Post the signup prompt, or edit it if its content or buttons have
+        changed. The message id and a digest of what it shows are kept as
+        preferences of the bot's own user, so otherwise nothing is sent.
+        """
+        async with self.prompt_lock:
+            await self._update_prompt()
+
+    async def _update_prompt(self):
+        content = """# MetroTas Cancellation Alerts
 :warning: THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR FAILURE OR OTHER DEALINGS IN THE SOFTWARE.
 
 ## Creating alerts
@@ -68,147 +174,111 @@ You can also checkout my [personal website](<https://maxstuff.net>) or my [YouTu
 ## Support
 Please get in touch with me@maxstuff.net or <@375884848294002689> if you need any help.
 
-:warning: Make sure to read this message in full before use.\n"""
-            + f"*Updated at {datetime.datetime.now()}*"
-        )
+:warning: Make sure to read this message in full before use."""
         view = PromptInitial()
+        digest = hashlib.sha256(
+            json.dumps([content, [item.custom_id for item in view.children]]).encode()
+        ).hexdigest()
 
-        channel = self.get_channel(1150695270267486359)
+        message_id = await database_controller.get_user_preference(
+            self.user.id, "prompt_message_id"
+        )
+        if message_id is not None and digest == (
+            await database_controller.get_user_preference(self.user.id, "prompt_digest")
+        ):
+            return
 
-        # check if there are any prompts in the channel already
-        async for message in channel.history(limit=10):
-            if message.author == self.user:
-                # edit the message
-                await message.edit(
-                    content=content,
-                    view=view,
+        channel = self.get_channel(PROMPT_CHANNEL_ID)
+        message = None
+        if message_id is not None:
+            try:
+                message = await channel.get_partial_message(int(message_id)).edit(
+                    content=content, view=view
                 )
-                self.prompt_creator_schedule_lock.release()
-                return
-
-        await channel.send(
-            content=content,
-            view=view,
+            except discord.NotFound:
+                pass
+        else:
+            # a prompt posted before its id was remembered
+            async for old_message in channel.history(limit=10):
+                if old_message.author == self.user:
+                    message = await old_message.edit(content=content, view=view)
+                    break
+        if message is None:
+            message = await channel.send(content=content, view=view)
+
+        await database_controller.set_user_preference(
+            self.user.id, "prompt_message_id", str(message.id)
+        )
+        await database_controller.set_user_preference(
+            self.user.id, "prompt_digest", digest
         )
-        self.prompt_creator_schedule_lock.release()
 
-    @discord.ext.tasks.loop(seconds=15)
+    @discord.ext.tasks.loop(seconds=0)
     async def send_alerts(self):
         if self.send_alerts_lock.locked():
             return
-        await self.send_alerts_lock.acquire()
-        for notification in database_controller.get_pending_notifications():
-            message_text = notification.text
-
-            if (
-                database_controller.get_user_preference(
-                    notification.recipient, "delivery_method"
-                )
-                == "discord_channel"
-            ):
-                # get channel that has name "notification_delivery_{user_id}"
-                channel_name = f"notification_delivery_{notification.recipient}"
-                channel = discord.utils.get(self.get_all_channels(), name=channel_name)
-                if channel is None:
-                    # create channel
-                    channel = await self.get_guild(
-                        1150694755618009168
-                    ).create_text_channel(name=channel_name)
-                    # set channel to private so only the user can see it
-                    await channel.set_permissions(
-                        self.get_guild(1150694755618009168).default_role,
-                        read_messages=False,
-                    )
-                    # get user object
-                    user = await self.fetch_user(int(notification.recipient))
-                    await channel.set_permissions(
-                        user,
-                        read_messages=True,
-                    )
-
-                heading_exists = False
-                heading_age = 0
-                heading = "***" + notification.heading + "***\n"
-                # check the previous messages to see if they have the same heading
-                async for message in channel.history(limit=100):
-                    if message.author == self.user:
-                        # if it starts with the same heading
-                        if message.content.startswith(heading):
-                            heading_exists = True
-                            break
-                        else:
-                            # check if there is a heading in the message
-                            if re.findall(r"\*{3}.+\*{3}", message.content):
-                                break
-                            else:
-                                heading_age += 1
-
-                if heading_exists:
-                    await channel.send(message_text)
-                else:
-                    await channel.send(
-                        heading + message_text,
-                    )
-                database_controller.mark_notification_sent(notification.id)
-            else:
-                user = await self.fetch_user(notification.recipient)
-                try:
-                    heading_exists = False
-                    heading_age = 0
-                    heading = "***" + notification.heading + "***\n"
-                    # check the previous messages to see if they have the same heading
-                    async for message in user.history(limit=100):
-                        if message.author == self.user:
-                            # if it starts with the same heading
-                            if message.content.startswith(heading):
-                                heading_exists = True
-                                break
-                            else:
-                                # check if there is a heading in the message
-                                if re.findall(r"\*{3}.+\*{3}", message.content):
-                                    break
-                                else:
-                                    heading_age += 1
-
-                    if heading_exists:
-                        await user.send(message_text)
-                    else:
-                        await user.send(
-                            heading + message_text,
-                        )
-
-                    database_controller.mark_notification_sent(notification.id)
-                except discord.errors.Forbidden as e:
-                    print(
-                        f"Could not send DM to {user.name}#{user.discriminator} ({user.id}) {e}, {type(e)}"
-                    )
-                    database_controller.set_user_preference(
-                        notification.recipient, "delivery_method", "discord_channel"
-                    )
-                    database_controller.send_notification(
-                        notification.recipient,
-                        "Your preferred delivery method has been set to Discord channel because you could not receive DMs from mutual server members. If you want to use DMs make sure to enable DMs from server members in the server settings, then change the setting in #signup",
-                    )
-
-        self.send_alerts_lock.release()
+        async with self.send_alerts_lock:
+            # anything queued while dispatching wakes the next round
+            await self.wakeup.wait(SAFETY_NET_POLL_SECONDS)
+            try:
+                await self.dispatcher.dispatch()
+            except Exception:
+                # an exception would stop the loop, and delivery with it
+                traceback.print_exc()
+
+    @discord.ext.tasks.loop(hours=6)
+    async def prune_notifications(self):
+        # only the bot does this, not the scraper worker
+        try:
+            await retention.run(database_controller)
+        except Exception:
+            traceback.print_exc()
 
     @discord.ext.tasks.loop(seconds=300)
     async def scrape(self):
         if self.scrape_lock.locked():
             return
-        await self.scrape_lock.acquire()
-        print("Scraping Metro website")
-        scraper.main()
-        self.scrape_lock.release()
-
+        async with self.scrape_lock:
+            print("Scraping Metro website")
+            try:
+                await scraper.main_async(database_controller)
+            except Exception:
+                # an exception would stop the loop, try again next time
+                traceback.print_exc()
+
+
+def invalidate_alerts_embed(user_id: int):
+    alerts_embeds.pop(user_id, None)
+
+
+async def get_alerts_embed(user_id: int, page: int = 0):
+    """
+    Return an embed of one page of a user's alerts, the page it shows and
+    the number of pages. Only that page is loaded from the database.
+    """
+    cached = alerts_embeds.get(user_id, {}).get(page)
+    if cached is not None:
+        alerts_embeds.move_to_end(user_id)
+        return cached[0], page, cached[1]
+
+    alerts, total = await database_controller.get_alert_page(
+        user_id, page * ALERTS_PER_PAGE, ALERTS_PER_PAGE
+    )
+    pages = max(1, math.ceil(total / ALERTS_PER_PAGE))
+    if page >= pages:
+        # alerts were deleted since the page was shown
+        return await get_alerts_embed(user_id, pages - 1)
 
-def get_alerts_embed(user_id: int) -> discord.Embed:
     response_embed = discord.Embed(
         title="Your Alerts",
-        description="Here are all of your alerts.",
+        description=(
+            "Here are all of your alerts."
+            if pages == 1
+            else f"Here are your alerts, page {page + 1} of {pages}."
+        ),
         color=discord.Color.yellow(),
     )
-    for alert in database_controller.get_alerts(user_id):
+    for alert in alerts:
         message = ""
         if alert.route:
             message += f"The"
@@ -234,7 +304,18 @@ def get_alerts_embed(user_id: int) -> discord.Embed:
             value=message,
             inline=False,
         )
-    return response_embed
+
+    alerts_embeds.setdefault(user_id, {})[page] = (response_embed, pages)
+    alerts_embeds.move_to_end(user_id)
+    while len(alerts_embeds) > ALERTS_EMBED_CACHE_USERS:
+        alerts_embeds.popitem(last=False)
+    return response_embed, page, pages
+
+
+async def alerts_message(user_id: int, page: int = 0):
+    """The embed and view for a message showing a page of a user's alerts."""
+    embed, page, pages = await get_alerts_embed(user_id, page)
+    return {"embed": embed, "view": AlertsPage(page, pages)}
 
 
 class NewAlert(discord.ui.Modal, title="New Alert"):
@@ -271,30 +352,43 @@ class NewAlert(discord.ui.Modal, title="New Alert"):
                 ephemeral=True,
             )
             return
+        # respond before writing, a write can wait seconds for the scraper's
+        # batch to commit and Discord only waits 3 seconds for a response
+        await interaction.response.defer(ephemeral=True, thinking=True)
         if self.route_number.value.startswith("2"):
-            await interaction.response.send_message(
+            await interaction.followup.send(
                 "School routes are extremly unlikely to be listed in the cancellations list on Metro's site, expect this to be inaccurate.",
                 ephemeral=True,
             )
-        database_controller.new_alert(
+        alert = await database_controller.new_alert(
             interaction.user.id,
             self.route_number.value,
             self.originate_time.value,
             self.direction.value,
         )
-        await interaction.response.send_message(
+        invalidate_alerts_embed(interaction.user.id)
+        await interaction.followup.send(
             f"Your alert for the {self.route_number.value} bus at {self.originate_time.value} in the {self.direction.value} direction has been created.",
-            embed=get_alerts_embed(interaction.user.id),
-            view=Prompt(),
+            **await alerts_message(interaction.user.id),
             ephemeral=True,
         )
+        # the scraper won't match lines it has already seen against new alerts
+        try:
+            await scraper.backfill_alerts(database_controller, [alert])
+        except Exception:
+            traceback.print_exc()
 
     async def on_error(
         self, interaction: discord.Interaction, error: Exception
     ) -> None:
-        await interaction.response.send_message(
-            "Oops! Something went wrong.", ephemeral=True
-        )
+        if interaction.response.is_done():
+            await interaction.followup.send(
+                "Oops! Something went wrong.", ephemeral=True
+            )
+        else:
+            await interaction.response.send_message(
+                "Oops! Something went wrong.", ephemeral=True
+            )
 
         # Make sure we know what the error actually is
         traceback.print_exception(type(error), error, error.__traceback__)
@@ -305,14 +399,15 @@ class DeliveryMethodMenu(discord.ui.View):
     async def discord_DM(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        database_controller.set_user_preference(
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await database_controller.set_user_preference(
             interaction.user.id, "delivery_method", "discord_DM"
         )
-        database_controller.send_notification(
+        await database_controller.send_notification(
             interaction.user.id,
             "Your preferred delivery method has been set to Discord DM.",
         )
-        await interaction.response.send_message(
+        await interaction.followup.send(
             "Your preferred delivery method has been set to Discord DM.",
             ephemeral=True,
         )
@@ -321,14 +416,15 @@ class DeliveryMethodMenu(discord.ui.View):
     async def discord_channel(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        database_controller.set_user_preference(
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await database_controller.set_user_preference(
             interaction.user.id, "delivery_method", "discord_channel"
         )
-        database_controller.send_notification(
+        await database_controller.send_notification(
             interaction.user.id,
             "Your preferred delivery method has been set to Discord channel.",
         )
-        await interaction.response.send_message(
+        await interaction.followup.send(
             "Your preferred delivery method has been set to Discord channel.",
             ephemeral=True,
         )
@@ -346,18 +442,20 @@ class Prompt(discord.ui.View):
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
         await interaction.response.send_message(
-            embed=get_alerts_embed(interaction.user.id), view=Prompt(), ephemeral=True
+            **await alerts_message(interaction.user.id),
+            ephemeral=True,
         )
 
     @discord.ui.button(label="Send test alert", style=discord.ButtonStyle.secondary)
     async def test_alert(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        database_controller.send_notification(
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await database_controller.send_notification(
             interaction.user.id,
             "This is a test alert.",
         )
-        await interaction.response.send_message(
+        await interaction.followup.send(
             "Test alert sent. If you do not receive it, check that you can receive DMs from server members.",
             view=Prompt(),
             ephemeral=True,
@@ -376,15 +474,95 @@ class Prompt(discord.ui.View):
         )
 
 
+class AlertsPage(Prompt):
+    """Prompt with buttons to move between the pages of the user's alerts."""
+
+    def __init__(self, page, pages):
+        super().__init__()
+        self.page = page
+        if pages == 1:
+            self.remove_item(self.previous_page)
+            self.remove_item(self.next_page)
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = page >= pages - 1
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        await interaction.response.edit_message(
+            **await alerts_message(interaction.user.id, page)
+        )
+
+    @discord.ui.button(label="Refresh", style=discord.ButtonStyle.primary)
+    async def view_alerts(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show_page(interaction, self.page)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, row=1)
+    async def previous_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, row=1)
+    async def next_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show_page(interaction, self.page + 1)
+
+
 class PromptInitial(Prompt):
-    @discord.ui.button(label="View Alerts", style=discord.ButtonStyle.primary)
+    """
+    The signup prompt, which handles its buttons for as long as the bot runs.
+    Only its buttons have fixed ids, an ephemeral Prompt with the same ids
+    would replace these handlers and remove them when it timed out.
+    """
+
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(
+        label="Create Alert",
+        style=discord.ButtonStyle.green,
+        custom_id="prompt:create_alert",
+    )
+    async def create_alert(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await Prompt.create_alert(self, interaction, button)
+
+    @discord.ui.button(
+        label="View Alerts",
+        style=discord.ButtonStyle.primary,
+        custom_id="prompt:view_alerts",
+    )
     async def view_alerts(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
         await interaction.response.send_message(
-            embed=get_alerts_embed(interaction.user.id), view=Prompt(), ephemeral=True
+            **await alerts_message(interaction.user.id),
+            ephemeral=True,
         )
 
+    @discord.ui.button(
+        label="Send test alert",
+        style=discord.ButtonStyle.secondary,
+        custom_id="prompt:test_alert",
+    )
+    async def test_alert(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await Prompt.test_alert(self, interaction, button)
+
+    @discord.ui.button(
+        label="Change delivery method",
+        style=discord.ButtonStyle.secondary,
+        custom_id="prompt:change_delivery_method",
+    )
+    async def change_delivery_method(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await Prompt.change_delivery_method(self, interaction, button)
+
 
 client = SubscribeClient()
 
@@ -397,18 +575,18 @@ async def delete_alert(
     interaction: discord.Interaction,
     alert_id: int,
 ):
-    if database_controller.delete_alert(interaction.user.id, alert_id):
-        await interaction.response.send_message(
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if await database_controller.delete_alert(interaction.user.id, alert_id):
+        invalidate_alerts_embed(interaction.user.id)
+        await interaction.followup.send(
             f"Alert with ID {alert_id} has been deleted.",
-            embed=get_alerts_embed(interaction.user.id),
-            view=Prompt(),
+            **await alerts_message(interaction.user.id),
             ephemeral=True,
         )
     else:
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"Alert with ID {alert_id} does not exist.",
-            embed=get_alerts_embed(interaction.user.id),
-            view=Prompt(),
+            **await alerts_message(interaction.user.id),
             ephemeral=True,
         )
 
@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import random
+import time
+import urllib.parse
+
+import aiohttp
+
+import metrics
+
+
+USER_AGENT = "metrotas-cancellation-alertion (+https://github.com/maxfire2008/metrotas-cancellation-alertion)"
+
+# statuses worth asking again for, anything else fails straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# connection failures and timeouts are retried too
+RETRY_EXCEPTIONS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+HTTP_RETRIES = metrics.Counter(
+    "http_retries_total", "Requests retried after a transient failure.", ["reason"]
+)
+CIRCUIT_OPENED = metrics.Counter(
+    "http_circuit_opened_total", "Times a host was given up on for a while.", ["host"]
+)
+
+
+def backoff(attempt, base, maximum):
+    """
+    Seconds to wait before retry number attempt (from 0), a random amount up
+    to base doubled for every attempt so retries from several requests don't
+    line up.
+
+    >>> 0 <= backoff(3, 0.5, 10) <= 4
+    True
+    >>> backoff(20, 0.5, 10) <= 10
+    True
+    """
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a host that is down."""
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host that keeps failing. Once failure_threshold
+    requests in a row have failed, each after its retries, requests to the
+    host raise CircuitOpenError for reset_timeout seconds. Then a single
+    request is let through: if it works the host is used again, otherwise it
+    is given up on for another reset_timeout.
+
+    Kept between scrapes, so it outlives any one Fetcher.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    >>> breaker.failure("example.com", now=0)
+    >>> breaker.failure("example.com", now=1)
+    http_client.py: example.com IS DOWN, failed 2 times
+    >>> breaker.check("example.com", now=10)
+    Traceback (most recent call last):
+    ...
+    http_client.CircuitOpenError: example.com failed 2 times in a row, retrying in 21s
+    >>> breaker.check("example.com", now=31)
+    >>> breaker.check("example.com", now=31)
+    Traceback (most recent call last):
+    ...
+    http_client.CircuitOpenError: example.com failed 2 times in a row, retrying in 30s
+    >>> breaker.success("example.com")
+    >>> breaker.check("example.com", now=32)
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> failures in a row
+        self._failures = {}
+        # host -> when requests are next let through, for open circuits
+        self._retry_at = {}
+
+    def check(self, host, now=None):
+        """Raise CircuitOpenError if a request to host shouldn't be made."""
+        retry_at = self._retry_at.get(host)
+        if retry_at is None:
+            return
+        now = time.monotonic() if now is None else now
+        if now < retry_at:
+            raise CircuitOpenError(
+                f"{host} failed {self._failures[host]} times in a row, "
+                f"retrying in {retry_at - now:.0f}s"
+            )
+        # let this request through, and hold back the rest until it's done
+        self._retry_at[host] = now + self.reset_timeout
+
+    def success(self, host):
+        self._failures.pop(host, None)
+        self._retry_at.pop(host, None)
+
+    def failure(self, host, now=None):
+        failures = self._failures[host] = self._failures.get(host, 0) + 1
+        if failures >= self.failure_threshold:
+            now = time.monotonic() if now is None else now
+            if host not in self._retry_at:
+                CIRCUIT_OPENED.inc(host=host)
+                print(f"http_client.py: {host} IS DOWN, failed {failures} times")
+            self._retry_at[host] = now + self.reset_timeout
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host by at least min_interval seconds."""
+
+    def __init__(self, min_interval):
+        self._min_interval = min_interval
+        self._locks = {}
+        self._last_request = {}
+
+    async def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            delay = (
+                self._last_request.get(host, 0) + self._min_interval - time.monotonic()
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_request[host] = time.monotonic()
+
+
+class Response:
+    def __init__(self, url, body, etag=None, last_modified=None):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body_hash = hashlib.sha256(body).hexdigest()
+
+
+class HttpCache:
+    """
+    Persistent ETag/Last-Modified and body hash store, kept in the database so
+    it survives restarts. The counters show how much work the cache saves.
+    """
+
+    def __init__(self, database_controller):
+        self._database_controller = database_controller
+        self.stats = {
+            "not_modified": 0,
+            "unchanged_body": 0,
+            "misses": 0,
+            "bytes_downloaded": 0,
+            "bytes_saved": 0,
+        }
+
+    async def get(self, url):
+        return await self._database_controller.get_http_cache_entry(url)
+
+    async def remember(self, response):
+        """Store the validators for a response once it has been fully processed."""
+        await self._database_controller.set_http_cache_entry(
+            response.url,
+            response.etag,
+            response.last_modified,
+            response.body_hash,
+            len(response.body),
+        )
+
+    def reset_stats(self):
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def summary(self):
+        hits = self.stats["not_modified"] + self.stats["unchanged_body"]
+        return (
+            f"{hits} hits ({self.stats['not_modified']} not modified, "
+            f"{self.stats['unchanged_body']} unchanged body), "
+            f"{self.stats['misses']} misses, "
+            f"{self.stats['bytes_downloaded']} bytes downloaded, "
+            f"{self.stats['bytes_saved']} bytes saved"
+        )
+
+
+class Fetcher:
+    """
+    Pooled HTTP session for the scraper. At most max_concurrency requests are
+    in flight at once and requests to a single host are rate limited.
+    Transient failures are retried up to retries times with jittered
+    exponential backoff, and hosts that keep failing are given up on by the
+    circuit breaker.
+
+    Use as an async context manager so the session is always closed.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=4,
+        min_interval=0.5,
+        timeout=60,
+        cache=None,
+        retries=3,
+        backoff_base=1,
+        backoff_max=30,
+        breaker=None,
+    ):
+        self.cache = cache
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self._retries = retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._rate_limiter = HostRateLimiter(min_interval)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            timeout=self._timeout,
+            headers={"User-Agent": USER_AGENT},
+            connector=aiohttp.TCPConnector(limit=self._max_concurrency),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+        self._session = None
+
+    async def get(self, url, timeout=None):
+        """Fetch url and return the response body as bytes."""
+        response = await self._request(url, timeout)
+        return response.body
+
+    async def get_if_changed(self, url, timeout=None, force=False):
+        """
+        Fetch url with a conditional request. Returns None if the page has not
+        changed since it was last remembered in the cache, otherwise a
+        Response that should be passed to cache.remember() once processed.
+
+        With force=True the page is always downloaded and returned.
+        """
+        entry = None if self.cache is None else await self.cache.get(url)
+        headers = {}
+        if entry is not None and not force:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        response = await self._request(url, timeout, headers)
+        if self.cache is None:
+            return response
+
+        if response is None:
+            self.cache.stats["not_modified"] += 1
+            self.cache.stats["bytes_saved"] += entry.content_length or 0
+            return None
+
+        self.cache.stats["bytes_downloaded"] += len(response.body)
+        if entry is not None and entry.body_hash == response.body_hash and not force:
+            self.cache.stats["unchanged_body"] += 1
+            # this body was already processed, so keep the server's new
+            # validators or every later request sends stale ones and misses
+            if (response.etag, response.last_modified) != (
+                entry.etag,
+                entry.last_modified,
+            ):
+                await self.cache.remember(response)
+            return None
+
+        self.cache.stats["misses"] += 1
+        return response
+
+    async def _request(self, url, timeout=None, headers=None):
+        host = urllib.parse.urlsplit(url).netloc
+        self.breaker.check(host)
+        attempt = 0
+        while True:
+            try:
+                response = await self._request_once(url, timeout, headers)
+            except aiohttp.ClientResponseError as error:
+                if error.status not in RETRY_STATUSES:
+                    # the host answered, it just doesn't have this page
+                    self.breaker.success(host)
+                    raise
+                reason = str(error.status)
+                delay = backoff(attempt, self._backoff_base, self._backoff_max)
+                retry_after = (error.headers or {}).get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, min(int(retry_after), self._backoff_max))
+                failure = error
+            except RETRY_EXCEPTIONS as error:
+                reason = type(error).__name__
+                delay = backoff(attempt, self._backoff_base, self._backoff_max)
+                failure = error
+            else:
+                self.breaker.success(host)
+                return response
+
+            if attempt >= self._retries:
+                self.breaker.failure(host)
+                raise failure
+            attempt += 1
+            HTTP_RETRIES.inc(reason=reason)
+            print(f"http_client.py: RETRYING {url} in {delay:.1f}s after {failure!r}")
+            # outside the semaphore, so other requests carry on meanwhile
+            await asyncio.sleep(delay)
+
+    async def _request_once(self, url, timeout=None, headers=None):
+        async with self._semaphore:
+            await self._rate_limiter.wait(url)
+            kwargs = {}
+            if timeout is not None:
+                kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+            async with self._session.get(url, headers=headers, **kwargs) as response:
+                if response.status == 304:
+                    return None
+                response.raise_for_status()
+                return Response(
+                    url,
+                    await response.read(),
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
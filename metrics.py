@@ -0,0 +1,249 @@
+"""
+In-process counters, gauges and histograms, served in the Prometheus text
+format by serve() so a scraper (or curl) can see where the time goes.
+
+Metrics are created at import time by the modules that update them:
+
+    PAGES = metrics.Counter("scraper_pages_total", "Pages looked at.", ["result"])
+    PAGES.inc(result="fetched")
+"""
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+import aiohttp.web
+
+
+# the bot serves its metrics here, an empty value turns it off. Each process
+# serves its own, so the workers have their own defaults
+METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "127.0.0.1:8766")
+
+# seconds, from a fast SQLite query up to a slow scrape
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+
+_metrics = {}
+# coroutines run before every render, to refresh gauges that are expensive
+_collectors = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        if name in _metrics:
+            raise ValueError(f"metric {name} is already registered")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> value, updated from the database threads too
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield self.name + _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, value in self._samples():
+            lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    A total that only goes up.
+
+    >>> counter = Counter("doctest_requests_total", "Requests.", ["method"])
+    >>> counter.inc(method="GET")
+    >>> counter.inc(2, method="GET")
+    >>> counter.get(method="GET")
+    3
+    >>> print(counter.render())
+    # HELP doctest_requests_total Requests.
+    # TYPE doctest_requests_total counter
+    doctest_requests_total{method="GET"} 3
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("counters can only go up")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, like the length of a queue."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations into cumulative buckets, along with their sum.
+
+    >>> histogram = Histogram("doctest_seconds", "Time taken.", buckets=(0.1, 1))
+    >>> histogram.observe(0.05)
+    >>> histogram.observe(0.5)
+    >>> print(histogram.render())
+    # HELP doctest_seconds Time taken.
+    # TYPE doctest_seconds histogram
+    doctest_seconds_bucket{le="0.1"} 1
+    doctest_seconds_bucket{le="1"} 2
+    doctest_seconds_bucket{le="+Inf"} 2
+    doctest_seconds_sum 0.55
+    doctest_seconds_count 2
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts_sum = self._values.get(key)
+            if counts_sum is None:
+                counts_sum = self._values[key] = [[0] * len(self.buckets), 0]
+            counts_sum[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts_sum[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the body of a with statement takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            ]
+        for key, (counts, total) in sorted(values):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                le = (("le", _format_value(bucket)),)
+                yield (
+                    self.name + "_bucket" + _format_labels(self.labelnames, key, le),
+                    cumulative,
+                )
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + "_sum" + labels, total
+            yield self.name + "_count" + labels, cumulative
+
+
+def add_collector(collector):
+    """Run the coroutine function collector() before every render."""
+    _collectors.append(collector)
+
+
+def render():
+    return "\n".join(metric.render() for metric in _metrics.values()) + "\n"
+
+
+async def _handle(request):
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as error:
+            print(f"metrics.py: collector {collector.__name__} failed {error}")
+    return aiohttp.web.Response(
+        text=render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def serve(address=METRICS_ADDRESS):
+    """
+    Serve the metrics at http://address/metrics on the running event loop.
+    Returns the aiohttp runner, or None if address is empty or can't be used.
+    """
+    if not address:
+        return None
+    host, port = address.rsplit(":", 1)
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", _handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await aiohttp.web.TCPSite(runner, host, int(port)).start()
+    except OSError as error:
+        # e.g. another process on this host already serves there, which
+        # shouldn't stop this one from running
+        await runner.cleanup()
+        print(f"metrics.py: NOT serving metrics on {address} {error}")
+        return None
+    print(f"metrics.py: serving metrics on http://{address}/metrics")
+    return runner
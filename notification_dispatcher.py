@@ -0,0 +1,419 @@
+import asyncio
+import collections
+import datetime
+import os
+import re
+import socket
+import time
+import traceback
+
+import discord
+
+import metrics
+
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+# recipients are split by user id between this many delivery processes, the
+# bot delivers partition 0 and delivery_worker.py the others
+DELIVERY_PARTITIONS = int(os.environ.get("DELIVERY_PARTITIONS", "1"))
+
+NOTIFICATIONS_SENT = metrics.Counter(
+    "notifications_sent_total", "Notifications delivered.", ["delivery_method"]
+)
+NOTIFICATIONS_PENDING = metrics.Gauge(
+    "notifications_pending", "Notifications waiting to be delivered."
+)
+DELIVERY_LATENCY = metrics.Histogram(
+    "notification_delivery_latency_seconds",
+    "Time from a notification being queued to it being delivered.",
+)
+DELIVERY_FAILURES = metrics.Counter(
+    "notification_delivery_failures_total", "Recipients whose delivery failed."
+)
+DISPATCH_SECONDS = metrics.Histogram(
+    "notification_dispatch_seconds", "Time taken to deliver everything pending."
+)
+RATE_LIMIT_WAIT = metrics.Counter(
+    "discord_rate_limit_wait_seconds_total",
+    "Time spent waiting on Discord rate limits, ours or Discord's.",
+    ["limit"],
+)
+HEADING_CACHE = metrics.Counter(
+    "notification_heading_cache_total", "Heading cache lookups.", ["result"]
+)
+
+
+def coalesce(notifications, heading, limit=DISCORD_MESSAGE_LIMIT):
+    """
+    Merge notifications into as few messages as fit within limit characters,
+    one notification per line. heading ("" if it is not needed) is only put
+    at the start of the first message. Returns (content, notifications) pairs.
+
+    >>> import types
+    >>> notifications = [types.SimpleNamespace(text=t) for t in ["aaa", "bbb", "ccc"]]
+    >>> [content for content, _ in coalesce(notifications, "***H***\\n", limit=14)]
+    ['***H***\\naaa', 'bbb\\nccc']
+    """
+    messages = []
+    content = heading
+    batch = []
+    for notification in notifications:
+        candidate = content + ("\n" if batch else "") + notification.text
+        if batch and len(candidate) > limit:
+            messages.append((content, batch))
+            content = notification.text
+            batch = [notification]
+        else:
+            content = candidate
+            batch.append(notification)
+    if batch:
+        messages.append((content, batch))
+    return messages
+
+
+class HeadingCache:
+    """
+    Least recently used map of destination id to the last heading line sent
+    there, so the message history only has to be read on a cold cache.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._maxsize = maxsize
+        self._headings = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, destination_id):
+        """Return the last heading, "" if there was none, or None on a miss."""
+        heading = self._headings.get(destination_id)
+        if heading is None:
+            self.misses += 1
+            HEADING_CACHE.inc(result="miss")
+            return None
+        self.hits += 1
+        HEADING_CACHE.inc(result="hit")
+        self._headings.move_to_end(destination_id)
+        return heading
+
+    def set(self, destination_id, heading):
+        self._headings[destination_id] = heading
+        self._headings.move_to_end(destination_id)
+        while len(self._headings) > self._maxsize:
+            self._headings.popitem(last=False)
+
+
+class RecipientCache:
+    """
+    Maps recipients to their delivery channel and user objects so they don't
+    have to be found by scanning every channel or fetched over the API for
+    every notification. Channels are kept in sync with the gateway events.
+    """
+
+    CHANNEL_PREFIX = "notification_delivery_"
+
+    def __init__(self, client):
+        self._client = client
+        self._channels = {}
+        self._users = {}
+        self.warmed = False
+
+    def warm(self):
+        self._channels.clear()
+        for channel in self._client.get_all_channels():
+            self.channel_created(channel)
+        self.warmed = True
+
+    def channel_created(self, channel):
+        if channel.name.startswith(self.CHANNEL_PREFIX):
+            self._channels[channel.name[len(self.CHANNEL_PREFIX) :]] = channel
+
+    def channel_deleted(self, channel):
+        recipient = channel.name[len(self.CHANNEL_PREFIX) :]
+        cached = self._channels.get(recipient)
+        if cached is not None and cached.id == channel.id:
+            del self._channels[recipient]
+
+    def channel_updated(self, before, after):
+        self.channel_deleted(before)
+        self.channel_created(after)
+
+    async def refresh(self, guild):
+        """
+        Reload the guild's channels over the API. Used before creating a
+        channel, so a worker without the gateway's channel cache doesn't
+        create one that already exists.
+        """
+        for channel in await guild.fetch_channels():
+            self.channel_created(channel)
+
+    def get_channel(self, recipient):
+        if not self.warmed:
+            self.warm()
+        return self._channels.get(str(recipient))
+
+    async def get_user(self, recipient):
+        recipient = str(recipient)
+        user = self._users.get(recipient)
+        if user is None:
+            user = self._client.get_user(int(recipient))
+            if user is None:
+                user = await self._client.fetch_user(int(recipient))
+            self._users[recipient] = user
+        return user
+
+
+class NotificationDispatcher:
+    """
+    Delivers pending notifications. Notifications are grouped by recipient;
+    different recipients are delivered to concurrently (at most max_workers at
+    once) while each recipient's notifications are sent in order.
+
+    Several dispatchers, in any number of processes, can share a database:
+    notifications are claimed before they are sent, and recipients are split
+    between partitions dispatchers by user id so each recipient is only ever
+    delivered to by one of them.
+
+    database_controller is a DatabaseController.AsyncDatabaseController. The
+    client only needs the parts of discord.Client used here (user,
+    get_all_channels, get_guild, fetch_guild, get_user and fetch_user) so a
+    fake can stand in for it.
+    """
+
+    def __init__(
+        self,
+        client,
+        database_controller,
+        guild_id,
+        max_workers=8,
+        global_rate=40,
+        max_rate_limit_retries=3,
+        lease_seconds=300,
+        partition=0,
+        partitions=1,
+        worker_id=None,
+        claim_size=500,
+    ):
+        self._client = client
+        self._database_controller = database_controller
+        self._guild_id = guild_id
+        self._max_workers = max_workers
+        self._max_rate_limit_retries = max_rate_limit_retries
+        # how long claimed notifications are held if this process dies, a
+        # round of claim_size has to be delivered well within it
+        self._lease_seconds = lease_seconds
+        self._claim_size = claim_size
+        self._partition = partition
+        self._partitions = partitions
+        self.worker_id = (
+            worker_id or f"{socket.gethostname()}:{os.getpid()}:{partition}"
+        )
+        # Discord allows 50 requests per second across the whole bot, which is
+        # shared by every partition
+        self._send_interval = partitions / global_rate
+        self._send_lock = asyncio.Lock()
+        self._last_send = 0
+        self.headings = HeadingCache()
+        self.recipients = RecipientCache(client)
+
+    async def count_pending(self):
+        """Refresh the pending notifications gauge, for metrics.add_collector()."""
+        NOTIFICATIONS_PENDING.set(
+            await self._database_controller.count_pending_notifications()
+        )
+
+    async def dispatch(self):
+        """Deliver everything pending. Returns the number of notifications sent."""
+        with DISPATCH_SECONDS.time():
+            return await self._dispatch()
+
+    async def _dispatch(self):
+        sent = 0
+        while True:
+            pending = await self._database_controller.claim_pending_notifications(
+                self._lease_seconds,
+                self.worker_id,
+                self._partition,
+                self._partitions,
+                self._claim_size,
+            )
+            try:
+                round_sent = await self._deliver(pending)
+            finally:
+                # whatever wasn't sent can be picked up again straight away
+                if pending:
+                    await self._database_controller.release_notifications(
+                        [notification.id for notification in pending], self.worker_id
+                    )
+            sent += round_sent
+            # stop if that was everything, or nothing could be delivered
+            if len(pending) < self._claim_size or round_sent == 0:
+                return sent
+
+    async def _deliver(self, pending):
+        by_recipient = {}
+        for notification in pending:
+            by_recipient.setdefault(notification.recipient, []).append(notification)
+
+        if not by_recipient:
+            return 0
+
+        semaphore = asyncio.Semaphore(self._max_workers)
+
+        async def worker(recipient, notifications):
+            async with semaphore:
+                return await self._deliver_to_recipient(recipient, notifications)
+
+        results = await asyncio.gather(
+            *(
+                worker(recipient, notifications)
+                for recipient, notifications in by_recipient.items()
+            ),
+            return_exceptions=True,
+        )
+
+        sent = 0
+        for recipient, result in zip(by_recipient, results):
+            if isinstance(result, Exception):
+                print(f"notification_dispatcher.py: DELIVERY TO {recipient} FAILED")
+                DELIVERY_FAILURES.inc()
+                traceback.print_exception(type(result), result, result.__traceback__)
+            else:
+                sent += result
+        return sent
+
+    async def _deliver_to_recipient(self, recipient, notifications):
+        delivery_method = await self._database_controller.get_user_preference(
+            recipient, "delivery_method"
+        )
+
+        if delivery_method == "discord_channel":
+            destination = await self._get_delivery_channel(recipient)
+        else:
+            destination = await self.recipients.get_user(recipient)
+
+        # one message (or as few as possible) per heading
+        by_heading = {}
+        for notification in notifications:
+            by_heading.setdefault(notification.heading, []).append(notification)
+
+        sent = 0
+        for heading, group in by_heading.items():
+            heading = "***" + heading + "***\n"
+            if await self._last_heading(destination) == heading:
+                prefix = ""
+            else:
+                prefix = heading
+
+            for content, batch in coalesce(group, prefix):
+                try:
+                    await self._send(destination, content)
+                except discord.errors.Forbidden as e:
+                    if delivery_method == "discord_channel":
+                        raise
+                    await self._fall_back_to_channel(destination, recipient, e)
+                    # the rest are delivered to the channel on the next round
+                    return sent
+                self.headings.set(destination.id, heading)
+                marked = await self._database_controller.mark_notifications_sent(
+                    [notification.id for notification in batch], self.worker_id
+                )
+                if marked < len(batch):
+                    print(
+                        f"notification_dispatcher.py: LEASE EXPIRED FOR {recipient}, "
+                        f"{len(batch) - marked} NOTIFICATIONS MAY BE SENT TWICE"
+                    )
+                self._record_delivery(batch, delivery_method)
+                sent += len(batch)
+        return sent
+
+    def _record_delivery(self, notifications, delivery_method):
+        # time_created comes from the database clock, which is UTC on SQLite
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        for notification in notifications:
+            if notification.time_created is not None:
+                DELIVERY_LATENCY.observe(
+                    max(0, (now - notification.time_created).total_seconds())
+                )
+        NOTIFICATIONS_SENT.inc(
+            len(notifications), delivery_method=delivery_method or "discord_DM"
+        )
+
+    async def _get_delivery_channel(self, recipient):
+        # get channel that has name "notification_delivery_{user_id}"
+        channel = self.recipients.get_channel(recipient)
+        if channel is None:
+            channel_name = RecipientCache.CHANNEL_PREFIX + str(recipient)
+            guild = self._client.get_guild(self._guild_id)
+            if guild is None:
+                # not connected to the gateway, see delivery_worker.py
+                guild = await self._client.fetch_guild(self._guild_id)
+            await self.recipients.refresh(guild)
+            channel = self.recipients.get_channel(recipient)
+        if channel is None:
+            # create channel
+            channel = await guild.create_text_channel(name=channel_name)
+            # set channel to private so only the user can see it
+            await channel.set_permissions(
+                guild.default_role,
+                read_messages=False,
+            )
+            # get user object
+            user = await self.recipients.get_user(recipient)
+            await channel.set_permissions(
+                user,
+                read_messages=True,
+            )
+            self.recipients.channel_created(channel)
+        return channel
+
+    async def _fall_back_to_channel(self, user, recipient, error):
+        print(
+            f"Could not send DM to {user.name}#{user.discriminator} ({user.id}) {error}, {type(error)}"
+        )
+        await self._database_controller.set_user_preference(
+            recipient, "delivery_method", "discord_channel"
+        )
+        await self._database_controller.send_notification(
+            recipient,
+            "Your preferred delivery method has been set to Discord channel because you could not receive DMs from mutual server members. If you want to use DMs make sure to enable DMs from server members in the server settings, then change the setting in #signup",
+        )
+
+    async def _last_heading(self, destination):
+        last_heading = self.headings.get(destination.id)
+        if last_heading is not None:
+            return last_heading
+
+        # cold cache, check the previous messages for the last heading sent
+        last_heading = ""
+        async for message in destination.history(limit=100):
+            if message.author == self._client.user:
+                # check if there is a heading in the message
+                if re.findall(r"\*{3}.+\*{3}", message.content):
+                    if message.content.startswith("***"):
+                        last_heading = message.content.split("\n", 1)[0] + "\n"
+                    break
+        self.headings.set(destination.id, last_heading)
+        return last_heading
+
+    async def _send(self, destination, content):
+        for attempt in range(self._max_rate_limit_retries + 1):
+            await self._wait_for_global_rate_limit()
+            try:
+                return await destination.send(content)
+            except discord.RateLimited as e:
+                if attempt == self._max_rate_limit_retries:
+                    raise
+                print(
+                    f"notification_dispatcher.py: RATE LIMITED, RETRYING IN {e.retry_after}s"
+                )
+                RATE_LIMIT_WAIT.inc(e.retry_after, limit="discord")
+                await asyncio.sleep(e.retry_after)
+
+    async def _wait_for_global_rate_limit(self):
+        async with self._send_lock:
+            delay = self._last_send + self._send_interval - time.monotonic()
+            if delay > 0:
+                RATE_LIMIT_WAIT.inc(delay, limit="global")
+                await asyncio.sleep(delay)
+            self._last_send = time.monotonic()
@@ -0,0 +1,242 @@
+"""
+Records the alerts index and its articles into a fixture directory, and
+replays them through a local HTTP stub to measure the scrape -> notify
+pipeline without touching metrotas.com.au.
+
+    python replay_harness.py record --output fixtures
+    python replay_harness.py replay --fixtures fixtures --alerts 10000 --runs 3
+
+The first replay run is cold. Later runs reuse the HTTP cache and the last
+scrape, the same as the bot does every 300 seconds.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import urllib.parse
+
+import aiohttp.web
+
+import DatabaseController
+import http_client
+import scraper
+
+
+ROUTES = [
+    "X1",
+    "X20",
+    "X42",
+    "X50",
+    "X61",
+    "401",
+    "501",
+    "502",
+    "521",
+    "601",
+    "736",
+    "940",
+]
+
+
+async def record(output):
+    os.makedirs(output, exist_ok=True)
+    manifest = {}
+
+    def save(url, body):
+        path = urllib.parse.urlsplit(url).path.strip("/").split("/")[-1]
+        name = (path or "index") + ".html"
+        with open(os.path.join(output, name), "wb") as file:
+            file.write(body)
+        manifest[url] = name
+        print(f"replay_harness.py: recorded {url} -> {name}")
+
+    async with http_client.Fetcher(max_concurrency=2, min_interval=1) as fetcher:
+        body = await fetcher.get(scraper.ALERTS_URL, timeout=10)
+        save(scraper.ALERTS_URL, body)
+        for date, title, url, description, location in scraper.parse_alerts_index(body):
+            # only Service Updates are ever downloaded by the scraper
+            if "Service Update" in title:
+                save(url, await fetcher.get(url, timeout=60))
+
+    with open(os.path.join(output, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=4)
+        file.write("\n")
+
+
+class ReplayServer:
+    """
+    Serves recorded pages from a fixture directory with ETags, rewriting the
+    recorded site's links so they point back at the stub.
+    """
+
+    def __init__(self, fixtures):
+        with open(os.path.join(fixtures, "manifest.json")) as file:
+            manifest = json.load(file)
+
+        self._origins = {
+            "{0.scheme}://{0.netloc}".format(urllib.parse.urlsplit(url))
+            for url in manifest
+        }
+        self._bodies = {}
+        for url, name in manifest.items():
+            with open(os.path.join(fixtures, name), "rb") as file:
+                self._bodies[urllib.parse.urlsplit(url).path] = file.read()
+
+        self.requests = 0
+        self.base_url = None
+        self._runner = None
+
+    def url(self, recorded_url):
+        return self.base_url + urllib.parse.urlsplit(recorded_url).path
+
+    async def _handle(self, request):
+        self.requests += 1
+        body = self._bodies.get(request.path)
+        if body is None:
+            return aiohttp.web.Response(status=404)
+        for origin in self._origins:
+            body = body.replace(origin.encode(), self.base_url.encode())
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if request.headers.get("If-None-Match") == etag:
+            return aiohttp.web.Response(status=304, headers={"ETag": etag})
+        return aiohttp.web.Response(
+            body=body, content_type="text/html", headers={"ETag": etag}
+        )
+
+    async def __aenter__(self):
+        app = aiohttp.web.Application()
+        app.router.add_get("/{path:.*}", self._handle)
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._runner.cleanup()
+
+
+def generate_alerts(database_controller, count, seed=0):
+    """Fill the database with count synthetic alerts."""
+    generator = random.Random(seed)
+    alerts = []
+    for i in range(count):
+        alerts.append(
+            {
+                "user_id": generator.randrange(max(count // 3, 1)),
+                "route": generator.choice(ROUTES + [""]),
+                "time": generator.choice(
+                    [
+                        f"{generator.randint(5, 23)}:"
+                        f"{generator.choice([0, 5, 12, 15, 27, 30, 42, 45, 50]):02}",
+                        "",
+                    ]
+                ),
+                "direction": generator.choice(["in", "out", ""]),
+            }
+        )
+    with database_controller._engine.begin() as connection:
+        connection.execute(DatabaseController.Alert.__table__.insert(), alerts)
+
+
+async def replay(fixtures, alert_count, runs, max_concurrency):
+    with tempfile.TemporaryDirectory() as directory:
+        sync_database_controller = DatabaseController.DatabaseController(
+            "sqlite:///" + os.path.join(directory, "replay.db")
+        )
+        generate_alerts(sync_database_controller, alert_count)
+        database_controller = DatabaseController.AsyncDatabaseController(
+            sync_database_controller
+        )
+
+        scraper.last_scrape["alerts"] = None
+        scraper.last_scrape["articles"] = None
+
+        results = []
+        async with ReplayServer(fixtures) as server:
+            for run in range(runs):
+                scraper.reset_stats()
+                requests = server.requests
+                start = time.perf_counter()
+                await scraper.main_async(
+                    database_controller,
+                    max_concurrency=max_concurrency,
+                    min_interval=0,
+                    alerts_url=server.url(scraper.ALERTS_URL),
+                )
+                results.append(
+                    {
+                        "run": run + 1,
+                        "wall": time.perf_counter() - start,
+                        "requests": server.requests - requests,
+                        **{
+                            stage: scraper.stage_seconds[stage]
+                            for stage in ["http", "parse", "match", "db"]
+                        },
+                        **scraper.counters,
+                    }
+                )
+    return results
+
+
+def print_results(alert_count, results):
+    print(f"\nreplayed with {alert_count} alerts")
+    print("stage times are in ms; http is summed over concurrent requests")
+    columns = [
+        ("run", "run", "{:>4}"),
+        ("wall", "wall", "{:>9.1f}"),
+        ("http", "http", "{:>9.1f}"),
+        ("parse", "parse", "{:>9.1f}"),
+        ("match", "match", "{:>9.1f}"),
+        ("db", "db", "{:>9.1f}"),
+        ("requests", "requests", "{:>9}"),
+        ("pages_unchanged", "unchanged", "{:>10}"),
+        ("lines_matched", "lines", "{:>7}"),
+        ("lines_skipped", "seen", "{:>7}"),
+        ("notifications_inserted", "notified", "{:>9}"),
+        ("notifications_skipped", "dupes", "{:>7}"),
+    ]
+    print("".join(f"{title:>{len(format.format(0))}}" for _, title, format in columns))
+    for result in results:
+        row = ""
+        for key, _, format in columns:
+            value = result.get(key, 0)
+            if key in ("wall", "http", "parse", "match", "db"):
+                value *= 1000
+            row += format.format(value)
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="save the live site")
+    record_parser.add_argument("--output", default="fixtures")
+
+    replay_parser = subparsers.add_parser("replay", help="scrape saved fixtures")
+    replay_parser.add_argument("--fixtures", default="fixtures")
+    replay_parser.add_argument("--alerts", type=int, default=1000)
+    replay_parser.add_argument("--runs", type=int, default=3)
+    replay_parser.add_argument("--max-concurrency", type=int, default=4)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record(args.output))
+    elif args.command == "replay":
+        results = asyncio.run(
+            replay(args.fixtures, args.alerts, args.runs, args.max_concurrency)
+        )
+        print_results(args.alerts, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Keeps the database small. Notifications sent more than
+RETENTION_DAYS ago are appended to gzipped JSON lines files in
+ARCHIVE_DIRECTORY (one per month sent) and removed from the database, their
+hashes are kept so they still aren't sent again, and the freed pages are given
+back to the filesystem with an incremental vacuum. Article lines first seen
+that long ago are forgotten too.
+
+The bot runs this on a schedule. Everything happens on the database
+controller's thread pool, in batches, so neither the event loop nor the
+scraper's writes are held up for long.
+"""
+
+import datetime
+import functools
+import gzip
+import json
+import os
+
+import metrics
+
+
+RETENTION_DAYS = int(os.environ.get("NOTIFICATION_RETENTION_DAYS", "30"))
+ARCHIVE_DIRECTORY = os.environ.get("NOTIFICATION_ARCHIVE_DIRECTORY", "archive")
+
+# notifications moved per transaction
+BATCH_SIZE = 1000
+
+NOTIFICATIONS_ARCHIVED = metrics.Counter(
+    "notifications_archived_total", "Sent notifications moved to the archive."
+)
+VACUUM_PAGES = metrics.Counter(
+    "database_vacuum_pages_total", "Database pages given back by incremental vacuum."
+)
+
+
+def write_archive(directory, notifications):
+    """Append notifications to the archive file for the month each was sent."""
+    os.makedirs(directory, exist_ok=True)
+    by_month = {}
+    for notification in notifications:
+        by_month.setdefault(notification.time_sent.strftime("%Y-%m"), []).append(
+            notification
+        )
+
+    for month, group in by_month.items():
+        path = os.path.join(directory, f"notifications-{month}.jsonl.gz")
+        # appending adds another gzip member, gzip.open() reads them all
+        with gzip.open(path, "at", encoding="utf-8") as file:
+            for notification in group:
+                file.write(
+                    json.dumps(
+                        {
+                            "id": notification.id,
+                            "hash": notification.hash and notification.hash.hex(),
+                            "heading": notification.heading,
+                            "text": notification.text,
+                            "recipient": notification.recipient,
+                            "time_created": str(notification.time_created),
+                            "time_sent": str(notification.time_sent),
+                        }
+                    )
+                    + "\n"
+                )
+
+
+async def archive_sent_notifications(
+    database_controller,
+    days=RETENTION_DAYS,
+    directory=ARCHIVE_DIRECTORY,
+    batch_size=BATCH_SIZE,
+):
+    """
+    Archive every notification sent more than days ago. database_controller
+    is a DatabaseController.AsyncDatabaseController. Returns the number
+    archived.
+    """
+    # time_sent comes from the database clock, which is UTC on SQLite
+    before = datetime.datetime.now(datetime.timezone.utc).replace(
+        tzinfo=None
+    ) - datetime.timedelta(days=days)
+    archive = functools.partial(write_archive, directory)
+
+    total = 0
+    while True:
+        archived = await database_controller.archive_notifications(
+            before, batch_size, archive
+        )
+        total += archived
+        NOTIFICATIONS_ARCHIVED.inc(archived)
+        if archived < batch_size:
+            return total
+
+
+async def run(database_controller, days=RETENTION_DAYS, directory=ARCHIVE_DIRECTORY):
+    archived = await archive_sent_notifications(database_controller, days, directory)
+    # lines seen this long ago are only rematched, and deduplicated, if seen again
+    lines = await database_controller.prune_article_lines(
+        datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        - datetime.timedelta(days=days)
+    )
+    pages = await database_controller.incremental_vacuum()
+    VACUUM_PAGES.inc(pages)
+    print(
+        f"retention.py: archived {archived} notifications to {directory}, "
+        f"forgot {lines} article lines, freed {pages} database pages"
+    )
@@ -1,87 +1,302 @@
 from pprint import pprint
-import requests
+import asyncio
 import bs4
+import collections
+import contextlib
 import datetime
-import re
+import time
+import traceback
 
-import sqlalchemy
 import DatabaseController
+import alert_index
+import http_client
+import metrics
 
 
-database_controller = DatabaseController.DatabaseController("sqlite:///database.db")
+ALERTS_URL = "https://www.metrotas.com.au/alerts/"
 
+# a new alert is matched against the lines first seen this recently
+BACKFILL_HOURS = 24
+# at most this many lines are kept in memory for it, oldest first
+RECENT_LINES_MAX = 20000
+# lines recorded this long before the last one loaded are read again, in
+# case they were committed after it
+RECENT_LINES_OVERLAP_SECONDS = 60
 
-def includes(a, b):
-    if a is None:
-        return True
-    return a.lower() in b.lower()
+# only these parts of the pages are read, so nothing else is built into a tree
+ALERTS_INDEX_STRAINER = bs4.SoupStrainer(
+    "div", attrs={"class": "article-body col-md-9"}
+)
+ARTICLE_STRAINER = bs4.SoupStrainer("article")
 
+# what the last completed scrape saw, so unchanged pages can be skipped
+last_scrape = {"alerts": None, "articles": None}
 
-def time_variations(time):
+# shared by every scrape, so a site that is down is left alone for a while
+circuit_breaker = http_client.CircuitBreaker()
+
+# seconds spent in each stage ("http", "parse", "match", "db") and counts of
+# what was done, summed across every article of a scrape
+stage_seconds = collections.defaultdict(float)
+counters = collections.Counter()
+
+SCRAPE_SECONDS = metrics.Histogram(
+    "scraper_scrape_seconds", "Time taken by a whole scrape.", ["result"]
+)
+STAGE_SECONDS = metrics.Counter(
+    "scraper_stage_seconds_total",
+    "Time spent in each stage of scraping, summed over concurrent articles.",
+    ["stage"],
+)
+PAGES = metrics.Counter(
+    "scraper_pages_total", "Pages fetched, skipped as unchanged, or failed.", ["result"]
+)
+LINES = metrics.Counter("scraper_lines_total", "Article lines matched against alerts.")
+LINES_SKIPPED = metrics.Counter(
+    "scraper_lines_skipped_total",
+    "Article lines skipped because they were matched before.",
+)
+ALERT_EVALUATIONS = metrics.Counter(
+    "scraper_alert_evaluations_total",
+    "Lines times the alerts they were matched against.",
+)
+NOTIFICATIONS_QUEUED = metrics.Counter(
+    "notifications_queued_total", "Notifications added to the queue."
+)
+NOTIFICATIONS_DUPLICATE = metrics.Counter(
+    "notifications_duplicate_total", "Matches skipped because they were already queued."
+)
+RECENT_LINES = metrics.Gauge(
+    "scraper_recent_lines", "Article lines kept in memory for backfilling new alerts."
+)
+
+
+class RecentLines:
     """
-    >>> time_variations("13:00")
-    ['13:00', '1:00', '1300', '100']
+    The article lines first seen in the last max_age seconds, kept in memory
+    so a new alert is matched without the network, in the bot as well as in
+    the process that scrapes. It follows the article_lines table, which the
+    scraper records every new line in, so every process keeps the same
+    lines: refresh_recent_lines() loads the last max_age seconds once, and
+    after that only what has been recorded since.
+
+    Lines are keyed by url and line_hash(), with when they were first seen in
+    wall clock seconds. Lines older than max_age are dropped, and the oldest
+    are dropped once there are more than max_lines.
+
+    >>> recent = RecentLines(max_lines=3, max_age=60)
+    >>> recent.add("a", b"1", "A", "one", seen=0)
+    >>> recent.add("a", b"2", "A", "two", seen=10)
+    >>> recent.add("a", b"1", "A", "one", seen=20)
+    >>> recent.add("b", b"3", "B", "three", seen=30)
+    >>> recent.add("b", b"4", "B", "four", seen=40)
+    >>> [text for url, heading, text in recent.lines(now=40)]
+    ['two', 'three', 'four']
+    >>> [text for url, heading, text in recent.lines(now=95)]
+    ['four']
     """
 
-    time_split = time.split(":")
-    try:
-        hour = int(time_split[0])
-        minute = int(time_split[1])
+    def __init__(self, max_lines=RECENT_LINES_MAX, max_age=BACKFILL_HOURS * 3600):
+        self.max_lines = max_lines
+        self.max_age = max_age
+        # (url, hash) -> (seen, heading, text), oldest first
+        self._lines = collections.OrderedDict()
+        # the newest time_first_seen loaded from the database
+        self.loaded_until = None
 
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, url, hash, heading, text, seen):
+        """Keep a line, unless it is already kept."""
+        if (url, hash) not in self._lines:
+            self._lines[(url, hash)] = (seen, heading, text)
+            self._evict(seen)
+
+    def _evict(self, now):
+        while self._lines:
+            seen = next(iter(self._lines.values()))[0]
+            if now - seen <= self.max_age and len(self._lines) <= self.max_lines:
+                break
+            self._lines.popitem(last=False)
+        RECENT_LINES.set(len(self._lines))
+
+    def lines(self, now=None):
+        """(url, heading, text) of every line still kept, oldest first."""
+        self._evict(time.time() if now is None else now)
         return [
-            time,
-            time.replace(":", ""),
-            f"{hour}:{minute:02}",
-            f"{hour}:{minute:02}".replace(":", ""),
+            (url, heading, text) for (url, _), (_, heading, text) in self._lines.items()
         ]
-    except ValueError:
-        return [time, time.replace(":", "")]
 
 
-def process_article(date, title, url, description, location):
+recent_lines = RecentLines()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds[stage] += elapsed
+        STAGE_SECONDS.inc(elapsed, stage=stage)
+
+
+def reset_stats():
+    stage_seconds.clear()
+    counters.clear()
+
+
+async def process_article(
+    fetcher,
+    database_controller,
+    date,
+    title,
+    url,
+    description,
+    location,
+    alerts=None,
+):
     print(f"scraper.py: {date} - {title} - {url} - {description} - {location}")
     if "Service Update" not in title:
         return
 
-    article_content = requests.get(url, timeout=60)
-    soup = bs4.BeautifulSoup(article_content.content, "html.parser")
+    with timed("http"):
+        response = await fetcher.get_if_changed(url, timeout=60)
+    if response is None:
+        print(f"scraper.py: UNCHANGED {url}")
+        counters["pages_unchanged"] += 1
+        PAGES.inc(result="unchanged")
+        return
+    counters["pages_fetched"] += 1
+    PAGES.inc(result="fetched")
+
+    with timed("parse"):
+        lines = parse_article(response.body)
+
+    if alerts is None:
+        with timed("db"):
+            alerts = await database_controller.get_alerts()
+        with timed("match"):
+            alerts = alert_index.AlertIndex(alerts)
+
+    heading = f"{title} - {location} {date} {url}"
+    hashes = [DatabaseController.line_hash(text) for text in lines]
+    # lines seen before were matched then, new alerts are backfilled instead
+    with timed("db"):
+        seen = await database_controller.get_article_line_hashes(url)
+    new_lines = [text for text, hash in zip(lines, hashes) if hash not in seen]
+    counters["lines_skipped"] += len(lines) - len(new_lines)
+    LINES_SKIPPED.inc(len(lines) - len(new_lines))
+
+    with timed("match"):
+        notifications = match_lines(alerts, url, heading, new_lines)
+    counters["lines_matched"] += len(new_lines)
+    counters["alerts_evaluated"] += len(new_lines) * len(alerts)
+    LINES.inc(len(new_lines))
+    ALERT_EVALUATIONS.inc(len(new_lines) * len(alerts))
+
+    if notifications:
+        with timed("db"):
+            inserted, skipped = await database_controller.send_notifications(
+                notifications
+            )
+        counters["notifications_inserted"] += inserted
+        counters["notifications_skipped"] += skipped
+        NOTIFICATIONS_QUEUED.inc(inserted)
+        NOTIFICATIONS_DUPLICATE.inc(skipped)
+        print(
+            f"scraper.py: SENT {inserted} NOTIFICATIONS, {skipped} ALREADY SENT FOR {url}"
+        )
+
+    # only once the notifications are queued, so a crash rematches the lines
+    with timed("db"):
+        await database_controller.record_article_lines(
+            url, heading, list(zip(hashes, lines))
+        )
+
+    if fetcher.cache is not None:
+        with timed("db"):
+            await fetcher.cache.remember(response)
+
+
+def match_lines(alerts, url, heading, lines):
+    """Match lines of an article against an AlertIndex and build notifications."""
+    notifications = []
+    for text in lines:
+        for alert in alerts.match(text):
+            notifications.append(
+                {
+                    "recipient": alert.user_id,
+                    "text": text,
+                    "heading": heading,
+                    "hash": DatabaseController.notification_hash(
+                        url, text, alert.user_id
+                    ),
+                }
+            )
+    return notifications
+
+
+async def refresh_recent_lines(database_controller):
+    """
+    Add the lines recorded in article_lines since the last refresh, by this
+    process or another one, to recent_lines.
+    """
+    since = time.time() - BACKFILL_HOURS * 3600
+    if recent_lines.loaded_until is not None:
+        since = max(since, recent_lines.loaded_until - RECENT_LINES_OVERLAP_SECONDS)
+    # time_first_seen is naive UTC
+    rows = await database_controller.get_recent_article_lines(
+        datetime.datetime.fromtimestamp(since, datetime.timezone.utc).replace(
+            tzinfo=None
+        )
+    )
+    for row in rows:
+        seen = row.time_first_seen.replace(tzinfo=datetime.timezone.utc).timestamp()
+        recent_lines.add(row.url, row.hash, row.heading, row.text, seen)
+        if recent_lines.loaded_until is None or seen > recent_lines.loaded_until:
+            recent_lines.loaded_until = seen
+
+
+async def backfill_alerts(database_controller, alerts):
+    """
+    Match new alerts against recent_lines, which the scraper won't look at
+    again. Returns the number of notifications queued.
+    """
+    await refresh_recent_lines(database_controller)
+
+    index = alert_index.AlertIndex(alerts)
+    notifications = []
+    for url, heading, text in recent_lines.lines():
+        notifications += match_lines(index, url, heading, [text])
+    if not notifications:
+        return 0
+    inserted, _ = await database_controller.send_notifications(notifications)
+    print(
+        f"scraper.py: BACKFILLED {inserted} NOTIFICATIONS FOR ALERTS "
+        + ", ".join(str(alert.id) for alert in alerts)
+    )
+    return inserted
+
+
+def parse_article(content):
+    soup = bs4.BeautifulSoup(content, "html.parser", parse_only=ARTICLE_STRAINER)
     article = soup.find("article")
 
     lines = []
 
     for paragraph in article.findAll("p"):
-        # replace \xa0+  with " "
-        text = re.sub(r" +", " ", paragraph.text.replace("\xa0", " "))
+        text = alert_index.normalise_text(paragraph.text)
         lines += text.split("\n")
-
-    for text in lines:
-        for alert in database_controller.get_alerts():
-            if (
-                includes("route", text)
-                and includes(alert.route, text)
-                and includes(alert.direction, text)
-                and any(includes(t, text) for t in time_variations(alert.time))
-            ):
-                try:
-                    database_controller.send_notification(
-                        alert.user_id,
-                        text,
-                        f"{title} - {location} {date} {url}",
-                        hash=repr((url, text, alert.user_id)),
-                    )
-                    print("scraper.py: SENT NOTIFICATION FOR", alert)
-                except sqlalchemy.exc.IntegrityError as error:
-                    # check that "UNIQUE constraint failed: notifications.hash" is the error
-                    if "UNIQUE constraint failed: notifications.hash" not in str(error):
-                        raise error
-                    else:
-                        print("scraper.py: ALREADY SENT NOTIFICATION FOR", alert)
+    return lines
 
 
-def main():
-    alerts_index = requests.get("https://www.metrotas.com.au/alerts/", timeout=10)
-    soup = bs4.BeautifulSoup(alerts_index.content, "html.parser")
+def parse_alerts_index(content):
+    soup = bs4.BeautifulSoup(content, "html.parser", parse_only=ALERTS_INDEX_STRAINER)
     articles = soup.find("div", {"class": "article-body col-md-9"})
+    parsed = []
     for article in articles.findAll("article"):
         date = datetime.datetime.fromisoformat(article.find("time").attrs["datetime"])
         title = article.find("h4").text
@@ -91,7 +306,105 @@ def main():
             description = None
         location = article.find("span").text
 
-        process_article(date, title, url, description, location)
+        parsed.append((date, title, url, description, location))
+    return parsed
+
+
+async def scrape(fetcher, database_controller, alerts_url=ALERTS_URL):
+    # load the alerts once for the whole scrape
+    with timed("db"):
+        alert_list = await database_controller.get_alerts()
+    with timed("match"):
+        alerts = alert_index.AlertIndex(alert_list)
+    print(f"scraper.py: matching against {len(alerts)} alerts")
+    # alerts created since the last scrape, NewAlert backfills them straight
+    # away but the bot may have missed some
+    if last_scrape["alerts"] is None:
+        added = []
+    else:
+        added = [alert for alert in alert_list if alert.id not in last_scrape["alerts"]]
+
+    with timed("http"):
+        index_response = await fetcher.get_if_changed(
+            alerts_url, timeout=10, force=last_scrape["articles"] is None
+        )
+    if index_response is None:
+        print("scraper.py: UNCHANGED alerts index")
+        counters["pages_unchanged"] += 1
+        PAGES.inc(result="unchanged")
+        articles = last_scrape["articles"]
+    else:
+        counters["pages_fetched"] += 1
+        PAGES.inc(result="fetched")
+        with timed("parse"):
+            articles = parse_alerts_index(index_response.body)
+
+    # the fetcher bounds how many of these are downloading at once
+    results = await asyncio.gather(
+        *(
+            process_article(
+                fetcher,
+                database_controller,
+                *article,
+                alerts=alerts,
+            )
+            for article in articles
+        ),
+        return_exceptions=True,
+    )
+    # an article that failed isn't remembered, so the next scrape tries again
+    for article, result in zip(articles, results):
+        if isinstance(result, http_client.CircuitOpenError):
+            counters["pages_failed"] += 1
+            PAGES.inc(result="failed")
+            print(f"scraper.py: SKIPPED {article[2]} {result}")
+        elif isinstance(result, Exception):
+            counters["pages_failed"] += 1
+            PAGES.inc(result="failed")
+            print(f"scraper.py: FAILED {article[2]}")
+            traceback.print_exception(type(result), result, result.__traceback__)
+        elif isinstance(result, BaseException):
+            raise result
+
+    if added:
+        with timed("match"):
+            await backfill_alerts(database_controller, added)
+
+    if index_response is not None and fetcher.cache is not None:
+        with timed("db"):
+            await fetcher.cache.remember(index_response)
+    last_scrape["articles"] = articles
+    last_scrape["alerts"] = {alert.id for alert in alert_list}
+
+
+async def main_async(
+    database_controller, max_concurrency=4, min_interval=0.5, alerts_url=ALERTS_URL
+):
+    cache = http_client.HttpCache(database_controller)
+    async with http_client.Fetcher(
+        max_concurrency=max_concurrency,
+        min_interval=min_interval,
+        cache=cache,
+        breaker=circuit_breaker,
+    ) as fetcher:
+        start = time.perf_counter()
+        result = "error"
+        try:
+            await scrape(fetcher, database_controller, alerts_url)
+            result = "ok"
+        except http_client.CircuitOpenError as error:
+            result = "skipped"
+            print(f"scraper.py: NOT SCRAPING, {error}")
+        finally:
+            SCRAPE_SECONDS.observe(time.perf_counter() - start, result=result)
+    print(f"scraper.py: cache {cache.summary()}")
+
+
+def main():
+    database_controller = DatabaseController.AsyncDatabaseController(
+        DatabaseController.DatabaseController(DatabaseController.DATABASE_URL)
+    )
+    asyncio.run(main_async(database_controller))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+"""
+Runs the scraper as its own process, separate from the Discord bot.
+
+Matches are written to the notifications table, which the bot drains, and the
+bot is woken through WAKEUP_ADDRESS. Run the bot with SCRAPE_IN_PROCESS=0 so
+it doesn't also scrape.
+
+    python scraper_worker.py --interval 300
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import traceback
+
+import DatabaseController
+import metrics
+import scraper
+import wakeup
+
+
+# not the bot's metrics.METRICS_ADDRESS, so both can run on one host
+METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "127.0.0.1:8767")
+
+
+async def run(interval):
+    sync_database_controller = DatabaseController.DatabaseController(
+        DatabaseController.DATABASE_URL
+    )
+    # wake the bot as soon as there is something for it to send
+    sync_database_controller.notification_listeners.append(wakeup.send_wakeup)
+    database_controller = DatabaseController.AsyncDatabaseController(
+        sync_database_controller
+    )
+    await metrics.serve(METRICS_ADDRESS)
+    while True:
+        started = time.monotonic()
+        print("scraper_worker.py: Scraping Metro website")
+        try:
+            await scraper.main_async(database_controller)
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the scraper on a schedule.")
+    parser.add_argument(
+        "--interval", type=int, default=300, help="seconds between scrapes"
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args.interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import socket
+
+
+# the bot listens here and the scraper worker sends here, senders can be
+# given a comma separated list to wake delivery workers too
+WAKEUP_ADDRESS = os.environ.get("WAKEUP_ADDRESS", "127.0.0.1:8765")
+# other delivery processes to wake when this one queues a notification
+WAKEUP_PEERS = os.environ.get("WAKEUP_PEERS", "")
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def send_wakeup(address=WAKEUP_ADDRESS):
+    """
+    Wake the bot from another process. This is best effort, a lost packet is
+    picked up by the bot's safety net poll.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for address in filter(None, (a.strip() for a in address.split(","))):
+            try:
+                sock.sendto(b"wakeup", parse_address(address))
+            except OSError as error:
+                print(f"wakeup.py: could not send wakeup to {address} {error}")
+
+
+class _WakeupProtocol(asyncio.DatagramProtocol):
+    def __init__(self, wakeup):
+        self._wakeup = wakeup
+
+    def datagram_received(self, data, addr):
+        self._wakeup.notify()
+
+
+class Wakeup:
+    """
+    Lets whatever queues a notification wake the dispatcher straight away
+    instead of it waiting for the next poll. Must be created on the event
+    loop; notify() is safe to call from any thread.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        """Wait until notified or until timeout seconds have passed."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+
+    async def listen(self, address=WAKEUP_ADDRESS):
+        """Also wake on datagrams sent by send_wakeup() from other processes."""
+        transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _WakeupProtocol(self), local_addr=parse_address(address)
+        )
+        return transport